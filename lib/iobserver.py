@@ -25,17 +25,29 @@ from pyinotify import *
 from pyinotify import Event as pyinotify_Event
 from configobj import ConfigObj, ConfigObjError
 
-from threading import Thread, Lock, Event
+from threading import Thread, Lock, RLock, Event, currentThread
 from glob import glob
 from types import ModuleType
 from time import time
+from collections import deque, OrderedDict
+from itertools import count
+from Queue import Queue, Empty
+from SocketServer import UnixStreamServer, StreamRequestHandler, ThreadingMixIn
 
 import imp
 import plugins
 
 import sys
 import os.path
+import stat
 import copy
+import re
+import fnmatch
+import heapq
+import json
+import gzip
+import cProfile
+import socket
 
 # Exception classes
 
@@ -84,10 +96,40 @@ class iPluginError(iPrivateError):
 # So it begins...
 class iPlugin(object):
 	""" Base class for plugins """
+
+	# The inotify events this plugin wants to receive.
+	# The watch subscribes only to the union of its plugins' masks,
+	# so plugins should narrow this down as much as possible.
+	mask = EventsCodes.ALL_EVENTS
+	
+	# An asynchronous plugin gets its events in a thread of its own
+	# (still one at a time, in order) instead of the watch's thread.
+	asynchronous = False
+	
+	# The options naming the files or directories the plugin writes
+	# to, so that tools (t/replay.py) can point them elsewhere.
+	# None if not known.
+	outputs = None
+	
+	# A plugin may also define process_events(events): it is then
+	# handed, in one call, the ordered list of events the watch read
+	# in one go (only those matching its mask), instead of having
+	# process_event called for each of them. A lone event and our
+	# own WATCH_* events still come through process_event.
+
 	def __init__(self, watch, cache, config):
 		self._config = config
 		self._cache = cache
 		self._watch = watch
+		# Our own part of the cache, dropped when the watch dies
+		self._region = None
+		if cache is not None and watch is not None:
+			self._region = cache.region(watch, self.__class__.__name__)
+
+	def get_mask(self):
+		""" Return the mask of the inotify events this plugin consumes.
+		Reimplement if the mask depends on the configuration. """
+		return self.mask
 
 	def process_event(self, event):
 		""" This is the method that is called to handle an event. """
@@ -102,51 +144,1038 @@ class iProcessEvent(ProcessEvent):
 		""" Do nothing, just pass event to the iWatch instance to handle. """
 		self._watch.process_event(event)
 
+class iCacheShard(object):
+	""" A part of the iCache, with its own lock. Volatile entries are
+	kept in order of use, for LRU eviction, and in order of pushing,
+	so that expiry only looks at the entries that have expired.
+	Persistent entries are kept apart and are never evicted. """
+	def __init__(self, max_entries):
+		self._volatile = OrderedDict()
+		self._pushed = OrderedDict()
+		self._persistent = {}
+		self._max_entries = max_entries
+		self._lock = Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+	
+	def __len__(self):
+		return len(self._volatile) + len(self._persistent)
+	
+	def _remove(self, key):
+		if self._persistent.has_key(key):
+			return self._persistent.pop(key)
+		if self._volatile.has_key(key):
+			del self._pushed[key]
+			return self._volatile.pop(key)
+		raise KeyError(key)
+	
+	def push(self, key, value, persistent):
+		self._lock.acquire()
+		try:
+			try:
+				self._remove(key)
+			except KeyError:
+				pass
+			if persistent:
+				self._persistent[key] = value
+			else:
+				self._volatile[key] = value
+				self._pushed[key] = time()
+				while self._max_entries and len(self._volatile) > self._max_entries:
+					(old_key, old_value) = self._volatile.popitem(last=False)
+					del self._pushed[old_key]
+					self.evictions += 1
+		finally:
+			self._lock.release()
+	
+	def pop(self, key):
+		self._lock.acquire()
+		try:
+			try:
+				result = self._remove(key)
+				self.hits += 1
+			except KeyError:
+				result = None
+				self.misses += 1
+			return result
+		finally:
+			self._lock.release()
+	
+	def get(self, key):
+		self._lock.acquire()
+		try:
+			if self._persistent.has_key(key):
+				self.hits += 1
+				return self._persistent[key]
+			if self._volatile.has_key(key):
+				# Move to the most recently used end
+				result = self._volatile.pop(key)
+				self._volatile[key] = result
+				self.hits += 1
+				return result
+			self.misses += 1
+			return None
+		finally:
+			self._lock.release()
+	
+	def expire(self, max_age):
+		""" Drop the entries pushed more than max_age seconds ago """
+		self._lock.acquire()
+		try:
+			limit = time() - max_age
+			while self._pushed:
+				# The oldest one; if it's still fresh, so are the rest
+				key = iter(self._pushed).next()
+				if self._pushed[key] >= limit:
+					break
+				del self._pushed[key]
+				del self._volatile[key]
+				self.expirations += 1
+		finally:
+			self._lock.release()
+
+class iCacheRegion(object):
+	""" The namespace of one plugin of one watch in the iCache, with
+	the same push/pop/get interface. Keys need no prefixes and the
+	whole region is dropped when the watch dies. """
+	def __init__(self, cache, shard):
+		self._cache = cache
+		self._shard = shard
+	
+	def __len__(self):
+		return len(self._shard)
+	
+	def push(self, key, value, persistent=False):
+		self._cache._count_push()
+		self._shard.push(key, value, persistent)
+	
+	def pop(self, key):
+		return self._shard.pop(key)
+	
+	def get(self, key):
+		return self._shard.get(key)
+
 class iCache(object):
 	""" A stash shared by all watches. Passed to plugins
-	to store data in, because plugin objects are not persistent. """
-	def __init__(self, max_age, expire_after_count):
-		self._cache = {}
+	to store data in, because plugin objects are not persistent.
+	
+	Keys are spread over 'shards' independently locked parts, so that
+	watches using the cache rarely wait for each other. Entries not
+	pushed as persistent expire max_age seconds after being pushed;
+	the expiry runs every expire_after_count pushes and only touches
+	the expired entries. With max_entries set, the least recently used
+	non persistent entries are evicted to stay within that bound.
+	
+	Plugins get regions of their own in each watch (see region()),
+	which are dropped as a whole after the watch's WATCH_DEAD. """
+	def __init__(self, max_age, expire_after_count, max_entries=0, shards=8):
 		self._max_age = max_age
-		self._expire_counter = 0
 		self._expire_after_count = expire_after_count
-		self._lock = Lock()
+		self._pushes = count(1)
+		self._bound = self._shard_bound(max_entries, shards)
+		self._shards = [iCacheShard(self._bound) for i in range(shards)]
+		# watch -> {plugin name -> iCacheRegion}
+		self._regions = {}
+		self._regions_lock = Lock()
 	
-	def push(self, key, value, persistent=False):
-		self._lock.acquire()
-		self._expire_counter += 1
-		if self._expire_counter > self._expire_after_count:
-			# Every N pushes, purge any old entries
+	def __len__(self):
+		return sum([len(shard) for shard in self._all_shards()])
+	
+	def _all_shards(self):
+		self._regions_lock.acquire()
+		try:
+			regions = [region._shard for regions in self._regions.values() for region in regions.values()]
+		finally:
+			self._regions_lock.release()
+		return self._shards + regions
+	
+	def region(self, watch, name):
+		""" Return the region of plugin 'name' in watch, creating it
+		on first use. Its entries stay around for as long as the watch. """
+		self._regions_lock.acquire()
+		try:
+			regions = self._regions.setdefault(watch, {})
+			if not regions.has_key(name):
+				regions[name] = iCacheRegion(self, iCacheShard(self._bound))
+			return regions[name]
+		finally:
+			self._regions_lock.release()
+	
+	def region_sizes(self, watch):
+		""" Number of entries in each region of watch """
+		self._regions_lock.acquire()
+		try:
+			regions = self._regions.get(watch, {}).items()
+		finally:
+			self._regions_lock.release()
+		return dict([(name, len(region)) for (name, region) in regions])
+	
+	def drop_regions(self, watch):
+		""" Forget everything the plugins of watch have stored """
+		self._regions_lock.acquire()
+		try:
+			self._regions.pop(watch, None)
+		finally:
+			self._regions_lock.release()
+	
+	def _shard_bound(self, max_entries, shards):
+		if not max_entries:
+			return 0
+		return max(1, (int(max_entries) + shards - 1) / shards)
+	
+	def _shard(self, key):
+		return self._shards[hash(key) % len(self._shards)]
+	
+	def set_max_entries(self, max_entries):
+		""" Change the bound; takes effect with the next pushes """
+		self._bound = self._shard_bound(max_entries, len(self._shards))
+		for shard in self._all_shards():
+			shard._max_entries = self._bound
+	
+	def _count_push(self):
+		# Every N pushes, purge any old entries. Counting is atomic.
+		if self._pushes.next() % (self._expire_after_count + 1) == 0:
 			self._expire()
-			self._expire_counter = 0
-		time_stamp = 0
-		if not persistent:
-			time_stamp = time()
-		self._cache[key] = (value, time_stamp)
-		self._lock.release()
+	
+	def push(self, key, value, persistent=False):
+		self._count_push()
+		self._shard(key).push(key, value, persistent)
 	
 	def pop(self, key):
-		self._lock.acquire()
-		(result, time_stamp) = self._cache.pop(key, (None, None))
-		self._lock.release()
-		return result
+		return self._shard(key).pop(key)
 	
 	def get(self, key):
+		return self._shard(key).get(key)
+	
+	def get_stats(self):
+		""" Return a dict with the number of entries and the hits,
+		misses, evictions and expirations so far """
+		shards = self._all_shards()
+		stats = {'entries': sum([len(shard) for shard in shards])}
+		for counter in ('hits', 'misses', 'evictions', 'expirations'):
+			stats[counter] = sum([getattr(shard, counter) for shard in shards])
+		return stats
+	
+	def _expire(self):
+		for shard in self._all_shards():
+			shard.expire(self._max_age)
+
+class iMetrics(object):
+	""" Runtime counters of a watch: events received by type and per
+	second (over the last minute), processing time of each plugin, as
+	totals and as a histogram, and the slowest events. Updated from
+	the watch thread and the threads of asynchronous plugins. """
+	
+	# Upper bounds (seconds) of the histogram buckets; one more is for the rest
+	buckets = (0.0001, 0.001, 0.01, 0.1, 1)
+	
+	def __init__(self, slowest=10):
+		self._lock = Lock()
+		self._started = time()
+		self._events = {}
+		self._total = 0
+		# [second, events in it] for the last minute
+		self._seconds = deque()
+		# plugin name -> [events, total time, histogram]
+		self._plugins = {}
+		# Min heap of (duration, plugin name, event name, path)
+		self._slowest = []
+		self._keep_slowest = slowest
+	
+	def count_event(self, event_name):
+		now = int(time())
 		self._lock.acquire()
-		(result, time_stamp) = self._cache.get(key, (None, None))
-		self._lock.release()
+		try:
+			self._events[event_name] = self._events.get(event_name, 0) + 1
+			self._total += 1
+			if self._seconds and self._seconds[-1][0] == now:
+				self._seconds[-1][1] += 1
+			else:
+				self._seconds.append([now, 1])
+			while self._seconds[0][0] <= now - 60:
+				self._seconds.popleft()
+		finally:
+			self._lock.release()
+	
+	def time_plugin(self, plugin_name, event, duration):
+		bucket = len(self.buckets)
+		for (index, bound) in enumerate(self.buckets):
+			if duration < bound:
+				bucket = index
+				break
+		self._lock.acquire()
+		try:
+			plugin = self._plugins.setdefault(plugin_name, [0, 0.0, [0] * (len(self.buckets) + 1)])
+			plugin[0] += 1
+			plugin[1] += duration
+			plugin[2][bucket] += 1
+			slow = (duration, plugin_name, event.event_name, os.path.join(event.path or '', getattr(event, 'name', None) or ''))
+			if len(self._slowest) < self._keep_slowest:
+				heapq.heappush(self._slowest, slow)
+			elif duration > self._slowest[0][0]:
+				heapq.heapreplace(self._slowest, slow)
+		finally:
+			self._lock.release()
+	
+	def get(self):
+		""" The counters as a dict """
+		now = time()
+		self._lock.acquire()
+		try:
+			recent = sum([count for (second, count) in self._seconds if second > now - 60])
+			labels = [str(bound) for bound in self.buckets] + ['inf']
+			plugins = {}
+			for (plugin_name, (events, total, histogram)) in self._plugins.items():
+				plugins[plugin_name] = {
+					'events': events,
+					'time': total,
+					'histogram': dict(zip(labels, histogram)),
+				}
+			return {
+				'events': self._total,
+				'events_by_type': self._events.copy(),
+				'events_per_second': recent / min(60.0, max(1.0, now - self._started)),
+				'plugins': plugins,
+				'slowest': [
+					{'time': duration, 'plugin': plugin_name, 'event': event_name, 'path': path}
+					for (duration, plugin_name, event_name, path) in sorted(self._slowest, reverse=True)
+				],
+			}
+		finally:
+			self._lock.release()
+
+def format_metrics(metrics, prefix=''):
+	""" Flatten the metrics to 'name value' lines, names joined with dots """
+	lines = []
+	if isinstance(metrics, dict):
+		items = sorted(metrics.items())
+	elif isinstance(metrics, list):
+		items = enumerate(metrics)
+	else:
+		return ["%s %s" % (prefix, metrics)]
+	for (key, value) in items:
+		lines.extend(format_metrics(value, prefix and "%s.%s" % (prefix, key) or str(key)))
+	return lines
+
+class iMetricsHandler(StreamRequestHandler):
+	""" Answers a request line of 'json' or 'text' (the default)
+	with the observer's metrics. 'profile <directory>' dumps the
+	plugin profiles there instead and answers with the files. """
+	def handle(self):
+		self.request.settimeout(5)
+		try:
+			request = self.rfile.readline(64).strip()
+		except IOError:
+			request = ''
+		if request.startswith('profile '):
+			# Dump the plugin profiles to the given directory
+			self.wfile.write("\n".join(self.server.observer.dump_profiles(request[8:].strip())) + "\n")
+			return
+		metrics = self.server.observer.get_metrics()
+		if request == 'json':
+			self.wfile.write(json.dumps(metrics) + "\n")
+		else:
+			self.wfile.write("\n".join(format_metrics(metrics)) + "\n")
+
+class iMetricsServer(ThreadingMixIn, UnixStreamServer):
+	""" Serves the metrics on a Unix socket (the 'metrics_socket'
+	global option), from a thread of its own. """
+	daemon_threads = True
+	
+	def __init__(self, observer, path):
+		self.observer = observer
+		self.path = path
+		if os.path.exists(path):
+			# Left behind by an earlier run
+			os.unlink(path)
+		UnixStreamServer.__init__(self, path, iMetricsHandler)
+		self._thread = Thread(target=self.serve_forever)
+		self._thread.setDaemon(True)
+		self._thread.start()
+	
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+class iTrace(object):
+	""" Records the events a watch receives, one JSON object per line
+	(gzipped if the file name ends in .gz): t, the seconds since the
+	first event; e, the event name; p, the path relative to the watch;
+	n, the name; d, set for directories; c, the cookie and s, the size
+	of files created or written to, so that a replay can make them. """
+	
+	_sized = ('IN_CREATE', 'IN_MODIFY', 'IN_CLOSE_WRITE', 'IN_MOVED_TO')
+	
+	def __init__(self, path, root):
+		self.path = path
+		self._root = root
+		if path.endswith('.gz'):
+			self._file = gzip.open(path, 'ab')
+		else:
+			self._file = file(path, 'a')
+		self._start = None
+	
+	def record(self, event):
+		now = time()
+		if self._start is None:
+			self._start = now
+		entry = {'t': round(now - self._start, 6), 'e': event.event_name}
+		if event.path is not None:
+			entry['p'] = os.path.relpath(event.path, self._root)
+		if getattr(event, 'name', None):
+			entry['n'] = event.name
+		if getattr(event, 'is_dir', False):
+			entry['d'] = 1
+		elif event.event_name in self._sized and event.path is not None:
+			try:
+				entry['s'] = os.lstat(os.path.join(event.path, event.name or '')).st_size
+			except OSError:
+				pass
+		if getattr(event, 'cookie', 0):
+			entry['c'] = event.cookie
+		self._file.write(json.dumps(entry, separators=(',', ':')) + "\n")
+	
+	def close(self):
+		self._file.close()
+
+def read_trace(path):
+	""" Yield the entries of a trace written by iTrace """
+	if path.endswith('.gz'):
+		input = gzip.open(path, 'rb')
+	else:
+		input = file(path, 'r')
+	try:
+		for line in input:
+			if line.strip():
+				yield json.loads(line)
+	finally:
+		input.close()
+
+class iCoalescer(object):
+	""" Holds back the events of a watch for a short window, so that
+	plugins see one net change per path: repeated IN_MODIFY/IN_ATTRIB
+	events are merged and an object both created and deleted within
+	the window is dropped altogether. The order of the remaining events
+	is kept. An event is released once it has been quiet for 'window'
+	seconds or has waited 'max_delay' seconds, whichever comes first. """
+	
+	_mergeable = ('IN_MODIFY', 'IN_ATTRIB')
+	
+	def __init__(self, window, max_delay):
+		self._window = window
+		self._max_delay = max_delay
+		# Entries are [event, first seen, last seen]; a cancelled
+		# entry has its event set to None and is skipped.
+		self._queue = deque()
+		# (path, name) -> live entries for it, in order
+		self._keys = {}
+	
+	def __len__(self):
+		return len(self._queue)
+	
+	def push(self, event, now=None):
+		if now is None:
+			now = time()
+		key = (event.path, event.name)
+		entries = self._keys.setdefault(key, [])
+		event_name = event.event_name
+		
+		if event_name in self._mergeable:
+			# Merge with a pending one of the same kind, unless something
+			# else happened to the path in between.
+			for entry in reversed(entries):
+				if not entry[0].event_name in self._mergeable:
+					break
+				if entry[0].event_name == event_name:
+					entry[2] = now
+					return
+		elif event_name == 'IN_DELETE' and entries and entries[0][0].event_name == 'IN_CREATE':
+			# Created and deleted within the window - nothing happened,
+			# unless a move involved it (the other half would be lost).
+			if not [entry for entry in entries if entry[0].event_name.startswith('IN_MOVE')]:
+				for entry in entries:
+					entry[0] = None
+				del self._keys[key]
+				return
+		
+		entry = [event, now, now]
+		entries.append(entry)
+		self._queue.append(entry)
+	
+	def _is_due(self, entry, now):
+		return now - entry[2] >= self._window or now - entry[1] >= self._max_delay
+	
+	def pop_due(self, now=None, force=False):
+		""" Return the events that should be passed on, in order.
+		With force all pending events are returned. """
+		if now is None:
+			now = time()
+		result = []
+		while self._queue:
+			entry = self._queue[0]
+			if entry[0] and not force and not self._is_due(entry, now):
+				break
+			self._queue.popleft()
+			if entry[0]:
+				key = (entry[0].path, entry[0].name)
+				entries = self._keys[key]
+				entries.pop(0)
+				if not entries:
+					del self._keys[key]
+				result.append(entry[0])
 		return result
 	
-	def _expire(self):
-		current_time = time()
-		for (key, (value, time_stamp)) in self._cache.items():
-			if time_stamp and current_time - time_stamp > self._max_age:
-				self._cache.pop(key)
+	def next_due(self, now=None):
+		""" Seconds until pop_due will have something to return,
+		or None if nothing is pending. """
+		if now is None:
+			now = time()
+		while self._queue and not self._queue[0][0]:
+			self._queue.popleft()
+		if not self._queue:
+			return None
+		(event, first, last) = self._queue[0]
+		return max(0, min(last + self._window, first + self._max_delay) - now)
+
+class iPathFilter(object):
+	""" Decides which paths below the root of a watch are of interest,
+	from include and exclude patterns compiled once. A pattern is a
+	glob, or a regular expression if it starts with 're:'. A glob
+	without a slash is matched against the name of an entry and of
+	each directory above it (.git, *.swp); one with a slash against
+	the path relative to the root and those of the directories above
+	it (build/out). Regular expressions are searched for in the
+	relative path. An excluded entry is left out with everything
+	below it. Include patterns keep only the files matching one of
+	them; directories are all kept, for the files below them. """
+	
+	# How many directories to remember the verdict on
+	max_directories = 10000
+	
+	def __init__(self, root, include=(), exclude=()):
+		self._prefix = root.rstrip(os.sep) + os.sep
+		self._include = self._compile(include)
+		self._exclude = self._compile(exclude)
+		self.excludes = bool(exclude)
+		# directory -> excluded
+		self._directories = {}
+	
+	def _compile(self, patterns):
+		""" One regular expression for each kind of pattern (or None).
+		Raises re.error for a bad one. """
+		names = []
+		paths = []
+		expressions = []
+		for pattern in patterns:
+			if pattern.startswith('re:'):
+				expressions.append(pattern[3:])
+			elif '/' in pattern:
+				paths.append(fnmatch.translate(pattern.strip('/')))
+			else:
+				names.append(fnmatch.translate(pattern))
+		return [kind and re.compile('|'.join(['(?:%s)' % pattern for pattern in kind])) or None
+				for kind in (names, paths, expressions)]
+	
+	def _matches(self, compiled, relative, name):
+		(names, paths, expressions) = compiled
+		return bool((names and names.match(name)) or (paths and paths.match(relative)) or
+				(expressions and expressions.search(relative)))
+	
+	def excluded(self, path):
+		""" True if path, or a directory above it, is excluded """
+		if not self.excludes or not path.startswith(self._prefix):
+			# The root itself is never excluded
+			return False
+		directory = os.path.dirname(path)
+		above = self._directories.get(directory)
+		if above is None:
+			above = self.excluded(directory)
+			if len(self._directories) >= self.max_directories:
+				self._directories.clear()
+			self._directories[directory] = above
+		return above or self._matches(self._exclude, path[len(self._prefix):], os.path.basename(path))
+	
+	def wanted(self, path, is_dir):
+		""" True if the plugins should hear about path """
+		if self.excluded(path):
+			return False
+		if is_dir or not [kind for kind in self._include if kind] or not path.startswith(self._prefix):
+			return True
+		return self._matches(self._include, path[len(self._prefix):], os.path.basename(path))
+
+class iSnapshot(object):
+	""" A compact picture of a tree: (inode, is_dir, size, mtime, mode,
+	uid, gid) of each entry and the names in each directory. A rescan lists again only
+	the directories whose mtime has changed since the previous picture,
+	and the differences between two pictures can be turned into the
+	events that would have told about them. Entries an iPathFilter
+	doesn't want are left out. """
+	def __init__(self, path, path_filter=None):
+		self._path = path
+		self._filter = path_filter
+		self._entries = {}
+		self._children = {}
+	
+	def __len__(self):
+		return len(self._entries)
+	
+	def directories(self):
+		return len(self._children)
+	
+	def _stat(self, path):
+		try:
+			result = os.lstat(path)
+		except OSError:
+			return None
+		return (result.st_ino, stat.S_ISDIR(result.st_mode), result.st_size, result.st_mtime,
+				stat.S_IMODE(result.st_mode), result.st_uid, result.st_gid)
+	
+	def scan(self, previous=None, pause=None):
+		""" Take the picture. pause, if given, is called every
+		1000 entries to let a big scan go easy on the system. """
+		self._entries = {}
+		self._children = {}
+		self._scan(self._path, previous, pause)
+	
+	def _scan(self, path, previous, pause):
+		info = self._stat(path)
+		if not info:
+			return
+		self._entries[path] = info
+		if not info[1]:
+			return
+		count = 0
+		stack = [path]
+		while stack:
+			directory = stack.pop()
+			names = None
+			if previous:
+				old = previous._entries.get(directory)
+				new = self._entries[directory]
+				if old and old[0] == new[0] and old[3] == new[3] and previous._children.has_key(directory):
+					# Unchanged directory, no need to list it
+					names = previous._children[directory]
+			if names is None:
+				try:
+					names = set(os.listdir(directory))
+				except OSError:
+					names = set()
+			self._children[directory] = set(names)
+			for name in names:
+				child = os.path.join(directory, name)
+				info = self._stat(child)
+				if not info or self._filter and not self._filter.wanted(child, info[1]):
+					self._children[directory].discard(name)
+					continue
+				self._entries[child] = info
+				if info[1]:
+					stack.append(child)
+				count += 1
+				if pause and count % 1000 == 0:
+					pause()
+	
+	def update(self, path):
+		""" Something happened to path - look at it again. """
+		info = self._stat(path)
+		if not info:
+			self.remove(path)
+			return
+		(parent, name) = os.path.split(path)
+		if self._children.has_key(parent):
+			self._children[parent].add(name)
+		if info[1] and not self._entries.has_key(path):
+			# A directory new to us - take all of it
+			self._scan(path, None, None)
+			return
+		self._entries[path] = info
+		if info[1]:
+			# Events may have been lost since it was listed;
+			# a rescan should list it again.
+			self._children.pop(path, None)
+	
+	def remove(self, path):
+		""" path is gone, with everything below it. """
+		(parent, name) = os.path.split(path)
+		if self._children.has_key(parent):
+			self._children[parent].discard(name)
+		stack = [path]
+		while stack:
+			path = stack.pop()
+			self._entries.pop(path, None)
+			for name in self._children.pop(path, ()):
+				stack.append(os.path.join(path, name))
+	
+	def _event(self, event_name, path, is_dir):
+		(directory, name) = os.path.split(path)
+		return pyinotify_Event(
+			{
+			'event_name': event_name,
+			'path': directory,
+			'name': name,
+			'is_dir': is_dir,
+			'cookie': 0,
+			'synthetic': True,
+			}
+		)
+	
+	def diff(self, previous):
+		""" Return the synthetic events that turn previous into us:
+		deletions (of whole subtrees, reported once), then creations
+		(parents first), then modifications, then changes of permissions
+		or owner alone. """
+		created = []
+		deleted = []
+		modified = []
+		changed = []
+		for (path, info) in self._entries.iteritems():
+			if path == self._path:
+				continue
+			old = previous._entries.get(path)
+			if not old:
+				created.append(path)
+			elif old[0] != info[0] or old[1] != info[1]:
+				# Replaced by something else
+				deleted.append(path)
+				created.append(path)
+			elif not info[1] and (old[2] != info[2] or old[3] != info[3]):
+				modified.append(path)
+			elif old[4:] != info[4:]:
+				changed.append(path)
+		for path in previous._entries.iterkeys():
+			if path != self._path and not self._entries.has_key(path):
+				deleted.append(path)
+		
+		gone = set(deleted)
+		events = [self._event('IN_DELETE', path, previous._entries[path][1])
+				for path in sorted(deleted) if not os.path.dirname(path) in gone]
+		events.extend([self._event('IN_CREATE', path, self._entries[path][1]) for path in sorted(created)])
+		events.extend([self._event('IN_MODIFY', path, False) for path in sorted(modified)])
+		events.extend([self._event('IN_ATTRIB', path, self._entries[path][1]) for path in sorted(changed)])
+		return events
+
+class iPluginWorker(object):
+	""" Stands in the dispatch table of a watch for an asynchronous
+	plugin: its events are queued and processed, in order, in a thread
+	of its own, so that slow I/O in the plugin overlaps with the
+	watch reading events and running the other plugins. The thread
+	is started by the watch, from its own thread. """
+	def __init__(self, watch, plugin_name, plugin):
+		self._watch = watch
+		self._plugin_name = plugin_name
+		self._plugin = plugin
+		self._queue = Queue()
+		self._thread = Thread(target=self.run)
+		self._thread.setDaemon(True)
+		self._started = False
+	
+	def start(self):
+		if not self._started:
+			self._started = True
+			self._thread.start()
+	
+	def process_event(self, event):
+		self._queue.put(event)
+	
+	def process_events(self, events):
+		self._queue.put(events)
+	
+	def run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+			if not isinstance(item, list):
+				item = [item]
+			elif hasattr(self._plugin, 'process_events'):
+				# A batch for a plugin taking batches
+				item = [item]
+			for events in item:
+				try:
+					self._watch._call_plugin(self._plugin_name, self._plugin, events)
+				except iPluginError, data:
+					iWatchError(self._watch._observer, "Watch: %s: Plugin '%s' reported error: %s" % (self._watch.get_path(), self._plugin_name, data))
+				except:
+					iWatchError(self._watch._observer, "Watch: %s: Unknown error in plugin '%s'." % (self._watch.get_path(), self._plugin_name))
+	
+	def pending(self):
+		""" Number of events (or batches of events) waiting to be processed """
+		return self._queue.qsize()
+	
+	def stop(self):
+		""" Process what is queued and stop. """
+		if not self._started:
+			return
+		self._queue.put(None)
+		self._thread.join()
+
+class iTreeWalker(object):
+	""" Lists all directories below a path with several threads, as
+	listing a directory is mostly waiting for the disk (or network).
+	Symbolic links are not followed, nor directories an iPathFilter
+	excludes. """
+	def __init__(self, path, workers, path_filter=None):
+		self._path = path
+		self._workers = workers
+		self._filter = path_filter
+		self._pending = Queue()
+		self._found = Queue()
+		self._cancelled = False
+	
+	def cancel(self):
+		self._cancelled = True
+	
+	def _subdirectories(self, path):
+		result = []
+		try:
+			names = os.listdir(path)
+		except OSError:
+			# Gone already or no permission
+			return result
+		for name in names:
+			subdirectory = os.path.join(path, name)
+			if self._filter and self._filter.excluded(subdirectory):
+				continue
+			try:
+				if stat.S_ISDIR(os.lstat(subdirectory).st_mode):
+					result.append(subdirectory)
+			except OSError:
+				pass
+		return result
+	
+	def _work(self):
+		while True:
+			path = self._pending.get()
+			if path is None:
+				break
+			if self._cancelled:
+				self._found.put([])
+			else:
+				self._found.put(self._subdirectories(path))
+	
+	def batches(self, size):
+		""" Yield lists of (about) size directories, upper levels first.
+		The path itself is not included. """
+		threads = [Thread(target=self._work) for i in range(self._workers)]
+		for thread in threads:
+			thread.setDaemon(True)
+			thread.start()
+		try:
+			self._pending.put(self._path)
+			outstanding = 1
+			batch = []
+			while outstanding:
+				subdirectories = self._found.get()
+				outstanding -= 1
+				for subdirectory in subdirectories:
+					self._pending.put(subdirectory)
+				outstanding += len(subdirectories)
+				batch.extend(subdirectories)
+				if len(batch) >= size:
+					yield batch
+					batch = []
+			if batch:
+				yield batch
+		finally:
+			self._cancelled = True
+			for thread in threads:
+				self._pending.put(None)
+
+class iEngineProcessEvent(ProcessEvent):
+	""" Event handler of the shared notifier engine. """
+	def __init__(self, engine):
+		self._engine = engine
+	
+	def process_default(self, event):
+		self._engine.route(event)
+
+class iNotifierEngine(object):
+	""" A single inotify instance, read by a single thread, serving all
+	watches of the observer (the 'shared_notifier' global option).
+	
+	Events are routed to the watches whose path contains them and are
+	put in their queues, so each watch still processes its events, and
+	goes through its life cycle, in its own thread. As nested watches
+	share kernel watches, all of them are registered with the union of
+	the watches' masks and each watch gets only the events it wants. """
+	def __init__(self, observer):
+		self._observer = observer
+		self._lock = Lock()
+		self._thread = Thread(target=self.run)
+		self._thread.setDaemon(True)
+		self._terminate_event = Event()
+		self._watch_manager = WatchManager()
+		self._notifier = Notifier(self._watch_manager, iEngineProcessEvent(self))
+		self._closed = False
+		# Set while no watch uses us
+		self._idle_event = Event()
+		self._idle_event.set()
+		self._mask = 0
+		# watched path -> iWatch instances
+		self._owners = {}
+		# iWatch -> watch descriptor of its path
+		self._roots = {}
+	
+	def start(self):
+		self._thread.start()
+	
+	def stop(self):
+		""" Stop reading. The inotify instance is closed by our thread
+		as soon as the last watch is removed. """
+		self._terminate_event.set()
+	
+	def run(self):
+		try:
+			while not self._terminate_event.isSet():
+				if self._notifier.check_events(timeout=1000):
+					self._lock.acquire()
+					try:
+						self._notifier.read_events()
+						self._notifier.process_events()
+					finally:
+						self._lock.release()
+		except NotifierError, data:
+			iWatchError(self._observer, "Error in the shared notifier: %s" % data)
+		# Nobody reads the inotify instance now: close it once no
+		# watch adds or removes kernel watches any more.
+		self._idle_event.wait()
+		self._lock.acquire()
+		try:
+			self._closed = True
+			self._notifier.stop()
+		finally:
+			self._lock.release()
+	
+	def _update_mask(self):
+		""" Register everything with the union of the watches' masks.
+		Called with the lock held. """
+		mask = 0
+		for watch in self._roots.keys():
+			mask |= watch._mask
+		if mask != self._mask:
+			self._mask = mask
+			for wd in self._roots.values():
+				if wd is not None and wd >= 0:
+					self._watch_manager.update_watch(wd, mask=mask, rec=True)
+	
+	def update_mask(self):
+		""" Called by a watch whose mask has changed. """
+		self._lock.acquire()
+		try:
+			self._update_mask()
+		finally:
+			self._lock.release()
+	
+	def add_watch(self, watch, paths, rec=True):
+		""" Start watching a path (or a list of paths) for watch.
+		Returns what WatchManager.add_watch does. """
+		self._lock.acquire()
+		try:
+			if self._closed:
+				return {}
+			if not self._roots.has_key(watch):
+				self._roots[watch] = None
+				self._idle_event.clear()
+				self._update_mask()
+			watches = self._watch_manager.add_watch(paths, self._mask, rec=rec, auto_add=True)
+			path = watch.get_path()
+			if watches.has_key(path):
+				self._roots[watch] = watches[path]
+				self._owners.setdefault(path, []).append(watch)
+			return watches
+		finally:
+			self._lock.release()
+	
+	def remove_path(self, watch, path):
+		""" watch doesn't want path watched (an auto added directory it
+		excludes): drop its kernel watch, unless another watch covers it. """
+		self._lock.acquire()
+		try:
+			if self._closed:
+				return
+			for (other, others) in self._owners.items():
+				if (path == other or path.startswith(other + os.sep)) and [o for o in others if o is not watch]:
+					return
+			wd = self._watch_manager.get_wd(path)
+			if wd is not None:
+				self._watch_manager.rm_watch(wd)
+		finally:
+			self._lock.release()
+	
+	def remove_watch(self, watch):
+		""" Stop watching for watch, keeping the kernel watches
+		that other watches still need. """
+		self._lock.acquire()
+		try:
+			if not self._roots.has_key(watch):
+				return
+			wd = self._roots.pop(watch)
+			path = watch.get_path()
+			owners = self._owners.get(path, [])
+			if watch in owners:
+				owners.remove(watch)
+				if not owners:
+					del self._owners[path]
+			
+			covered = [other for other in self._owners.keys() if path == other or path.startswith(other + os.sep)]
+			if wd is not None and wd >= 0 and not covered and not self._closed:
+				self._watch_manager.rm_watch(wd, rec=True)
+				# That took away the watches of any nested watches - put them back
+				for (other, others) in self._owners.items():
+					if other.startswith(path + os.sep):
+						watches = self._watch_manager.add_watch(other, self._mask, rec=True, auto_add=True)
+						for other_watch in others:
+							self._roots[other_watch] = watches.get(other)
+			
+			if not self._closed:
+				self._update_mask()
+			if not self._roots:
+				self._idle_event.set()
+		finally:
+			self._lock.release()
+		if self._terminate_event.isSet() and self._idle_event.isSet() and \
+				self._thread.isAlive() and currentThread() is not self._thread:
+			# Let our thread close the inotify instance
+			self._thread.join()
+	
+	def route(self, event):
+		""" Put an event in the queues of the watches it belongs to.
+		Called in our thread with the lock held. """
+		event_mask = getattr(EventsCodes, event.event_name, 0)
+		if event.event_name == 'IN_Q_OVERFLOW':
+			# Concerns everybody
+			targets = self._roots.keys()
+		else:
+			targets = []
+			path = event.path
+			while True:
+				targets.extend(self._owners.get(path, []))
+				parent = os.path.dirname(path)
+				if parent == path:
+					break
+				path = parent
+		for watch in targets:
+			if event_mask & watch._mask or event.event_name == 'IN_Q_OVERFLOW':
+				watch._queue.put(event)
 
 class iWatch(object):
 	""" Represents a single watched directory.
 	Watch the directory in a separate thread
 	using the desired plugins. """
+
+	# Events the watch needs for itself, whatever its plugins want:
+	# IN_CREATE to auto add new directories and the *_SELF events
+	# to stop when the watched item goes away.
+	_base_mask = EventsCodes.IN_CREATE | EventsCodes.IN_DELETE_SELF | EventsCodes.IN_MOVE_SELF
+	
+	# Whether we can use the observer's shared notifier engine
+	_uses_engine = True
+
 	def __init__(self, observer, available_plugins, config):
 		self._observer = observer
 		self._cache = observer._cache
@@ -155,12 +1184,50 @@ class iWatch(object):
 		self._terminate_event = Event()
 		self._error_event = Event()
 		self._config_changed_event = Event()
+		# Set once the main loop is over
+		self._stopped_event = Event()
+		# Set once our thread is running
+		self._started = False
+		# Also taken while processing events, which may add watches
+		self._register_lock = RLock()
+		self._progress = {'directories': 0, 'done': False}
+		# Paths we reported as created while scanning new directories
+		self._synthesized = {}
+		self._synthesized_order = deque()
+		self._metrics = iMetrics()
+		self._trace = None
+		# plugin name -> (cProfile.Profile, Lock), with profile_plugins
+		self._profiles = {}
+		self._profiles_lock = Lock()
+		self._profiling = False
+		self._slow_event = 0
+		# Moves waiting for their other half: cookie -> (IN_MOVED_FROM, deadline),
+		# and the cookie of each such source
+		self._moves = OrderedDict()
+		self._move_sources = {}
+		# What we know of the tree, to recover from lost events
+		self._snapshot = None
+		self._overflows = 0
+		self._rescan_pending = False
+		self._last_rescan = 0
 		self._config = None
 		self._path = None
 		self._avilable_plugins = None
 		self._watch_manager = None
 		self._notifier = None
 		self._watches = None
+		self._mask = self._base_mask
+		self._dispatch = []
+		self._signature = None
+		self._coalescer = None
+		self._filter = None
+		# Events read in one go, for plugins taking batches (None: not batching)
+		self._batch = None
+		# With a shared notifier engine our events come through the queue
+		self._engine = None
+		self._queue = Queue()
+		if self._uses_engine:
+			self._engine = observer._notifier_engine()
 		
 		self._configure(available_plugins, config)
 	
@@ -185,16 +1252,122 @@ class iWatch(object):
 			
 			return
 		
-		plugins = self._config['plugins']
-		
-		if not isinstance(plugins, list):
-			plugins = [plugins]
-		
-		for plugin in plugins:
+		for plugin in self._plugin_names(self._config):
 			if not self._available_plugins.has_key(plugin):
 				self._error_event.set()
 				iWatchError(self._observer, "Required plugin '%s' is missing." % plugin)
 		
+		self._build_dispatch()
+		self._signature = self._config_signature(available_plugins, config)
+		self._configure_coalescing()
+		self._configure_filter()
+		self.configure_profiling()
+	
+	def _configure_coalescing(self):
+		""" Set up event coalescing if 'coalesce_window_ms' is given. """
+		# Anything still pending was flushed by the caller
+		self._coalescer = None
+		if not self._config.has_key('coalesce_window_ms'):
+			return
+		try:
+			window = int(self._config['coalesce_window_ms'])
+			max_delay = int(self._config.get('coalesce_max_delay_ms', max(window, 1000)))
+		except ValueError:
+			self._error_event.set()
+			iWatchError(self._observer, "Watch %s: Bad coalesce_* option value." % self._path)
+			return
+		if window > 0:
+			self._coalescer = iCoalescer(window / 1000.0, max(window, max_delay) / 1000.0)
+	
+	def _configure_filter(self):
+		""" Compile the 'include' and 'exclude' patterns, if any. """
+		self._filter = None
+		patterns = []
+		for option in ('include', 'exclude'):
+			value = self._config.get(option, [])
+			if not isinstance(value, list):
+				value = [value]
+			patterns.append([pattern for pattern in value if pattern])
+		if not patterns[0] and not patterns[1]:
+			return
+		try:
+			self._filter = iPathFilter(self._path, *patterns)
+		except re.error, data:
+			self._error_event.set()
+			iWatchError(self._observer, "Watch %s: Bad include/exclude pattern: %s" % (self._path, data))
+	
+	def _plugin_names(self, config):
+		""" Return the plugins named in a watch config, in order, once each. """
+		plugins = config.get('plugins', [])
+		if not isinstance(plugins, list):
+			# In case we have a single plugin, it is a string
+			# and not a list...
+			plugins = [plugins]
+		result = []
+		for plugin in plugins:
+			if not plugin in result:
+				result.append(plugin)
+		return result
+	
+	def _plugin_factory(self, available_plugins, plugin_name):
+		""" Return the class for a plugin module or the plugin instance
+		itself (e.g. the iObserver). """
+		plugin = available_plugins.get(plugin_name)
+		if isinstance(plugin, ModuleType):
+			plugin = getattr(plugin, plugin_name.title(), None)
+		return plugin
+	
+	def _config_signature(self, available_plugins, config):
+		""" Everything the dispatch table depends on. A reloaded
+		plugin module has a new class, so it shows up here as a change. """
+		watch_config = config.values()[0]
+		factories = [(plugin_name, self._plugin_factory(available_plugins, plugin_name))
+				for plugin_name in self._plugin_names(watch_config)]
+		return (copy.deepcopy(config), factories)
+	
+	def _plugin_config(self, plugin_name):
+		""" Return the part of our config that belongs to a plugin. """
+		return dict([(key, self._config[key]) for key in self._config.keys() if key.startswith(plugin_name + '_')])
+	
+	def _build_dispatch(self):
+		""" Prepare the (name, plugin, mask) table process_event loops over
+		and the mask to subscribe with. Plugin instances live until the
+		next change of configuration or plugins. """
+		# Old asynchronous plugins finish their events before the new ones start
+		self._stop_workers()
+		dispatch = []
+		mask = self._base_mask
+		for plugin_name in self._plugin_names(self._config):
+			if not self._available_plugins.has_key(plugin_name):
+				continue
+			plugin = self._plugin_factory(self._available_plugins, plugin_name)
+			if isinstance(self._available_plugins[plugin_name], ModuleType):
+				if plugin is None:
+					self._error_event.set()
+					iWatchError(self._observer, "Plugin module '%s' has no class '%s'." % (plugin_name, plugin_name.title()))
+					continue
+				plugin = plugin(self, self._cache, self._plugin_config(plugin_name))
+			if hasattr(plugin, 'get_mask'):
+				plugin_mask = plugin.get_mask()
+			else:
+				plugin_mask = EventsCodes.ALL_EVENTS
+			if getattr(plugin, 'asynchronous', False):
+				plugin = iPluginWorker(self, plugin_name, plugin)
+			dispatch.append((plugin_name, plugin, plugin_mask))
+			mask |= plugin_mask
+		self._dispatch = dispatch
+		self._mask = mask
+	
+	def _start_workers(self):
+		for (plugin_name, plugin, plugin_mask) in self._dispatch:
+			if isinstance(plugin, iPluginWorker):
+				plugin.start()
+	
+	def _stop_workers(self):
+		for (plugin_name, plugin, plugin_mask) in self._dispatch:
+			if isinstance(plugin, iPluginWorker):
+				plugin.stop()
+	
 	def update_config(self, available_plugins, config):
 		""" Calles from iObserver whenever a change of plugins or config
 		is detected. """
@@ -206,28 +1379,56 @@ class iWatch(object):
 		self._new_config = config
 		self._lock.release()
 		self._config_changed_event.set()
+		if self._engine:
+			self._queue.put(None)
 	
 	def _reconfigure(self):
 		""" Called in the main watch thread so that no locking
-		of the configuration when reading is required. """
+		of the configuration when reading is required.
+		Returns False if nothing has actually changed. """
 		self._lock.acquire()
+		if self._config_signature(self._new_available_plugins, self._new_config) == self._signature:
+			self._lock.release()
+			return False
+		old_mask = self._mask
 		self._configure(self._new_available_plugins, self._new_config)
 		self._lock.release()
+		self._start_workers()
+		
+		if self._watches and self._mask != old_mask:
+			# Plugins changed their minds about what they want to see.
+			if self._engine:
+				self._engine.update_mask()
+			elif self._watch_manager:
+				self._watch_manager.update_watch(self._watches[self._path], mask=self._mask, rec=True)
+		return True
 	
 	def start(self):
 		if not self._terminate_event.isSet() and not self._error_event.isSet():
 			try:
+				self._started = True
 				self._thread.start()
+				return
 			except:
+				self._started = False
 				self._error_event.set()
 				iWatchError(self._observer, "Could not start watch thread.")
+		# run() will never drop the regions our plugins got
+		self._cache.drop_regions(self)
 	
 	def run(self):
 		""" Our thread's main executable """
+		try:
+			self._run()
+		finally:
+			self._cache.drop_regions(self)
+	
+	def _run(self):
 		# Send a custom WATCH_INIT event.
 		# Plugins may use this to do any "one time" initializations.
 		process_event = iProcessEvent(self)
 		
+		self._start_workers()
 		process_event.process_default(pyinotify_Event(
 			{
 			'event_name': 'WATCH_INIT',
@@ -235,51 +1436,37 @@ class iWatch(object):
 			}
 		))
 		
+		if self._engine:
+			self._run_shared(process_event)
+			return
+		
 		self._watch_manager = WatchManager()
 		self._notifier = Notifier(self._watch_manager, iProcessEvent(self))
 		try:
-			self._watches = self._watch_manager.add_watch(self._path, EventsCodes.ALL_EVENTS, rec=True, auto_add=True)
-			for watch in self._watches.keys():
-				if self._watches[watch] == -1:
-					# Error: path is missing?
-					iWatchError(self._observer, "Error watching %s. Maybe file or directory don't exist?" % watch)
-					return
+			if not self._register():
+				return
 			
 			# Rock'n'Roll baby!
 			while True:
-				self._notifier.process_events()
-				if self._notifier.check_events(timeout=1000):
-					self._notifier.read_events()
-				# Check if our config should be updated
-				if self._config_changed_event.isSet():
-					self._config_changed_event.clear()
-					self._reconfigure()
-					# Notify plugins that a configuration might be changed.
-					# They should act accordingly...
-					process_event.process_default(pyinotify_Event(
-						{
-						'event_name': 'WATCH_RECONFIG',
-						'path': self._path
-						}
-					))
-				# Check if we have to terminate:
-				if self._error_event.isSet():
-					self._terminate_event.set()
-				if self._terminate_event.isSet():
-					self._terminate_event.clear()
+				if self._notifier.check_events(timeout=self._poll_timeout()):
+					# A background registration may be adding watches
+					self._register_lock.acquire()
+					try:
+						self._begin_batch()
+						try:
+							self._notifier.read_events()
+							self._notifier.process_events()
+						finally:
+							self._end_batch()
+					finally:
+						self._register_lock.release()
+				if self._housekeeping(process_event):
+					self._register_lock.acquire()
 					self._notifier.stop()
+					self._register_lock.release()
 					break
 			
-			# Send a custom final event: WATCH_DEAD
-			# A plugin may use this to cleanup anything 
-			# left behind in the cache.
-			
-			process_event.process_default(pyinotify_Event(
-				{
-				'event_name': 'WATCH_DEAD',
-				'path': self._path
-				}
-			))
+			self._die(process_event)
 		
 		except NotifierError, data:
 			self._notifier.stop()
@@ -291,6 +1478,264 @@ class iWatch(object):
 			self._notifier.stop()
 			iWatchError(self._observer, "Unknown error while watching %s." % self._path)
 	
+	def _run_shared(self, process_event):
+		""" The main loop when the observer's shared notifier engine
+		reads the events for us and puts them in our queue. """
+		try:
+			if not self._register():
+				self._engine.remove_watch(self)
+				return
+			
+			while True:
+				events = []
+				try:
+					timeout = self._poll_timeout()
+					if timeout < 1000:
+						events.append(self._queue.get(True, timeout / 1000.0))
+					else:
+						# Wait for events, stop() or update_config()
+						events.append(self._queue.get())
+					while True:
+						events.append(self._queue.get_nowait())
+				except Empty:
+					pass
+				self._begin_batch()
+				try:
+					for event in events:
+						# None is just a wake-up call
+						if event:
+							process_event.process_default(event)
+				finally:
+					self._end_batch()
+				if self._housekeeping(process_event):
+					break
+			
+			self._engine.remove_watch(self)
+			self._die(process_event)
+		except:
+			self._engine.remove_watch(self)
+			iWatchError(self._observer, "Unknown error while watching %s." % self._path)
+	
+	def _add_watches(self, paths, rec):
+		""" Add kernel watches for a path or a list of paths. """
+		if self._engine:
+			watches = self._engine.add_watch(self, paths, rec)
+		else:
+			self._register_lock.acquire()
+			try:
+				if self._stopped_event.isSet():
+					return {}
+				watches = self._watch_manager.add_watch(paths, self._mask, rec=rec, auto_add=True)
+			finally:
+				self._register_lock.release()
+		self._watches.update(watches)
+		return watches
+	
+	def _register(self):
+		""" Watch our whole tree. By default pyinotify walks it. With
+		register_workers > 1 the tree is listed by several threads and
+		the watches are added in batches of register_batch; with
+		register_background set, that goes on while the events of the
+		directories already watched are being processed. Excluded
+		directories are never watched, so with exclude patterns we
+		always walk the tree ourselves.
+		Returns False if our path can't be watched. """
+		self._watches = {}
+		progress = self._progress
+		progress['directories'] = 0
+		progress['done'] = False
+		workers = int(self._config.get('register_workers', 1))
+		background = self._observer._is_true(self._config.get('register_background', False))
+		
+		if workers <= 1 and not background and not (self._filter and self._filter.excludes):
+			watches = self._add_watches(self._path, rec=True)
+			for watch in watches.keys():
+				if watches[watch] == -1:
+					# Error: path is missing?
+					iWatchError(self._observer, "Error watching %s. Maybe file or directory don't exist?" % watch)
+					return False
+			progress['directories'] = len(watches)
+			progress['done'] = True
+			self._take_snapshot()
+			return True
+		
+		if self._add_watches(self._path, rec=False).get(self._path, -1) == -1:
+			iWatchError(self._observer, "Error watching %s. Maybe file or directory don't exist?" % self._path)
+			return False
+		progress['directories'] = 1
+		if background:
+			thread = Thread(target=self._register_tree, args=(workers,))
+			thread.setDaemon(True)
+			thread.start()
+		else:
+			self._register_tree(workers)
+		self._take_snapshot()
+		return True
+	
+	def _register_tree(self, workers):
+		""" Add watches for everything below our path. """
+		try:
+			walker = iTreeWalker(self._path, workers, self._filter)
+			for batch in walker.batches(int(self._config.get('register_batch', 1000))):
+				if self._stopped_event.isSet():
+					walker.cancel()
+					return
+				# A directory that is gone already is not an error
+				watches = self._add_watches(batch, rec=False)
+				self._progress['directories'] += len([wd for wd in watches.values() if wd != -1])
+			self._progress['done'] = True
+		except:
+			if not self._stopped_event.isSet():
+				self._error_event.set()
+				iWatchError(self._observer, "Error registering watches for %s." % self._path)
+	
+	def _take_snapshot(self):
+		""" With overflow_rescan set, remember the state of the tree
+		so that lost events can be made up for. """
+		if self._observer._is_true(self._config.get('overflow_rescan', False)):
+			self._snapshot = iSnapshot(self._path, self._filter)
+			self._snapshot.scan(pause=self._rescan_pause)
+	
+	def _rescan_pause(self):
+		""" Called every 1000 entries of a scan. """
+		pause = int(self._config.get('overflow_rescan_pause_ms', 10))
+		if pause > 0:
+			self._terminate_event.wait(pause / 1000.0)
+	
+	def _track(self, event):
+		""" Keep the snapshot up to date with a received event. """
+		if not event.name:
+			return
+		path = os.path.join(event.path, event.name)
+		if event.event_name in ('IN_DELETE', 'IN_MOVED_FROM'):
+			self._snapshot.remove(path)
+		elif event.event_name in ('IN_CREATE', 'IN_MODIFY', 'IN_ATTRIB', 'IN_MOVED_TO', 'IN_CLOSE_WRITE'):
+			self._snapshot.update(path)
+	
+	def _rescan(self):
+		""" The kernel has dropped events: compare the tree with what we
+		knew and report just the differences. Watches are added for new
+		directories whose creation we have missed. """
+		self._rescan_pending = False
+		self._last_rescan = time()
+		snapshot = iSnapshot(self._path, self._filter)
+		snapshot.scan(self._snapshot, pause=self._rescan_pause)
+		events = snapshot.diff(self._snapshot)
+		self._snapshot = snapshot
+		
+		directories = [os.path.join(event.path, event.name) for event in events
+				if event.event_name == 'IN_CREATE' and event.is_dir]
+		if directories:
+			self._add_watches(directories, rec=False)
+		for event in events:
+			self.process_event(event)
+	
+	def get_metrics(self):
+		""" Our counters (see iMetrics), the work waiting to be done
+		and the size of our plugins' cache regions. """
+		metrics = self._metrics.get()
+		pending = {
+			'queue': self._engine and self._queue.qsize() or 0,
+			'coalesced': self._coalescer and len(self._coalescer) or 0,
+			'moves': len(self._moves),
+		}
+		for (plugin_name, plugin, plugin_mask) in self._dispatch:
+			if isinstance(plugin, iPluginWorker):
+				pending[plugin_name] = plugin.pending()
+		metrics['pending'] = pending
+		metrics['cache'] = self._cache.region_sizes(self)
+		metrics['overflows'] = self._overflows
+		metrics['directories'] = self._progress['directories']
+		return metrics
+	
+	def get_overflows(self):
+		""" How many times the kernel event queue has overflowed. """
+		return self._overflows
+	
+	def get_progress(self):
+		""" Return (directories watched so far, registration finished) """
+		return (self._progress['directories'], self._progress['done'])
+	
+	def _die(self, process_event):
+		""" Send a custom final event: WATCH_DEAD.
+		A plugin may use this to cleanup anything
+		left behind in the cache. Its cache region
+		is dropped when run() returns. """
+		process_event.process_default(pyinotify_Event(
+			{
+			'event_name': 'WATCH_DEAD',
+			'path': self._path
+			}
+		))
+		# Asynchronous plugins are done only when they have seen it
+		self._stop_workers()
+		if self._trace:
+			self._trace.close()
+			self._trace = None
+	
+	def _housekeeping(self, process_event):
+		""" Done after each round of events: release coalesced events,
+		apply any new configuration. Returns True if we have to stop. """
+		self._begin_batch()
+		try:
+			if self._rescan_pending and self._rescan_due() == 0:
+				self._rescan()
+			if self._moves:
+				self._expire_moves()
+			if self._coalescer:
+				self._flush_events()
+		finally:
+			self._end_batch()
+		# Check if our config should be updated
+		if self._config_changed_event.isSet():
+			self._config_changed_event.clear()
+			self._flush_events(force=True)
+			if self._reconfigure():
+				# Notify plugins that a configuration might be changed.
+				# They should act accordingly...
+				process_event.process_default(pyinotify_Event(
+					{
+					'event_name': 'WATCH_RECONFIG',
+					'path': self._path
+					}
+				))
+		# Check if we have to terminate:
+		if self._error_event.isSet():
+			self._terminate_event.set()
+		if self._terminate_event.isSet():
+			self._terminate_event.clear()
+			self._stopped_event.set()
+			return True
+		return False
+	
+	def _rescan_due(self):
+		""" Seconds until the next rescan is allowed. Overflows tend to
+		come in storms; rescanning once every overflow_rescan_interval
+		seconds (5) is enough. """
+		interval = float(self._config.get('overflow_rescan_interval', 5))
+		return max(0, self._last_rescan + interval - time())
+	
+	def _poll_timeout(self):
+		""" How long (ms) to wait for new events: a second, or less if
+		coalesced events, a rescan or a move's timeout are due earlier. """
+		timeout = 1000
+		if self._coalescer:
+			due = self._coalescer.next_due()
+			if due is not None:
+				timeout = min(timeout, int(due * 1000) + 1)
+		if self._rescan_pending:
+			timeout = min(timeout, int(self._rescan_due() * 1000) + 1)
+		if self._moves:
+			deadline = self._moves[iter(self._moves).next()][1]
+			timeout = min(timeout, int(max(0, deadline - time()) * 1000) + 1)
+		return timeout
+	
+	def _flush_events(self, force=False):
+		""" Pass on the coalesced events whose time has come. """
+		if self._coalescer:
+			for event in self._coalescer.pop_due(force=force):
+				self._dispatch_event(event)
+	
 	def process_event(self, event):
 		""" iProcessEvent calls this to handle an event.
 		I could have used iWatch as an event handler directly given
@@ -299,14 +1744,20 @@ class iWatch(object):
 		plugin for plugin management:) """
 		
 		# Our job is to call each of the plugins' process_event methods.
-		# Plugins are instantiated each time, so that a reloaded plugin
-		# could be updated.
+		# Plugins are instantiated when the dispatch table is built, so
+		# that a reloaded plugin is picked up on the next reconfiguration.
 		
 		# If we are stopped (or rather "stopping", ignore any events:
 		# We need to clear the terminate_event in order our
 		# final WATCH_DEAD event to pass. This is done in the run method.
 		if self._error_event.isSet() or self._terminate_event.isSet():
 			return
+		self._metrics.count_event(event.event_name)
+		if self._filter and getattr(event, 'name', None) and not event.event_name.startswith('WATCH_') and \
+				self._filtered_out(event):
+			return
+		if not event.event_name.startswith('WATCH_') and not getattr(event, 'synthetic', False):
+			self._record(event)
 		
 		# Some special handling:
 		# If the watched directory is moved - stop watching it,
@@ -321,44 +1772,372 @@ class iWatch(object):
 		if event.event_name == 'IN_DELETE_SELF' and event.path == self._path:
 			self.stop()
 		
-		plugins = self._config['plugins']
-		if not isinstance(plugins, list):
-			# In case we have a single plugin, it is a string
-			# and not a list...
-			plugins = [plugins]
-		plugins = set(plugins)
+		synthetic = getattr(event, 'synthetic', False)
+		if event.event_name == 'IN_Q_OVERFLOW':
+			# Events were lost - rescan as soon as allowed
+			self._overflows += 1
+			if self._snapshot:
+				self._rescan_pending = True
+		elif self._snapshot and not synthetic and not event.event_name.startswith('WATCH_'):
+			self._track(event)
 		
-		for plugin_name in plugins:
-			if self._available_plugins.has_key(plugin_name):
-				
-				plugin_config = dict([(key, self._config[key]) for key in self._config.keys() if key.startswith(plugin_name + '_')])
-				
-				plugin_class = None
-				plugin = None
-				if isinstance(self._available_plugins[plugin_name], ModuleType):
-					plugin_class = self._available_plugins[plugin_name].__getattribute__(plugin_name.title())
-					plugin = plugin_class(self, self._cache, plugin_config)
-				else:
-					plugin = self._available_plugins[plugin_name]
-				
-				# Process event
+		if event.event_name == 'IN_CREATE' and not synthetic:
+			created = os.path.join(event.path, event.name)
+			self._forget_synthesized(time())
+			if self._synthesized.has_key(created):
+				# Already reported while scanning a new directory
+				del self._synthesized[created]
+				return
+		elif event.event_name in ('IN_DELETE', 'IN_MOVED_FROM') and not synthetic and self._synthesized:
+			# Whatever comes back there later is new
+			removed = os.path.join(event.path, event.name)
+			for created in self._synthesized.keys():
+				if created == removed or created.startswith(removed + os.sep):
+					del self._synthesized[created]
+		
+		if event.event_name in ('IN_MOVED_FROM', 'IN_MOVED_TO') and not synthetic and \
+				self._observer._is_true(self._config.get('correlate_moves', False)):
+			self._correlate_move(event)
+		else:
+			if event.event_name.startswith('WATCH_'):
+				# Pending moves are over before our own events
+				self._expire_moves(force=True)
+			elif self._move_sources.has_key((event.path, getattr(event, 'name', None))):
+				# Something new in place of a pending move's source:
+				# that one must have left the tree.
+				self._expire_move(self._move_sources[(event.path, event.name)])
+			self._pass_on(event)
+		
+		if event.event_name == 'IN_CREATE' and getattr(event, 'is_dir', False) and not synthetic and \
+				self._observer._is_true(self._config.get('scan_new_directories', True)):
+			self._scan_new_directory(created)
+	
+	def _filtered_out(self, event):
+		""" True if the filter doesn't want the event. An excluded
+		directory has had a watch auto added when created: drop it. """
+		path = os.path.join(event.path, event.name)
+		if self._filter.wanted(path, getattr(event, 'is_dir', False)):
+			return False
+		if event.event_name == 'IN_CREATE' and getattr(event, 'is_dir', False) and \
+				not getattr(event, 'synthetic', False):
+			self._remove_watch(path)
+		return True
+	
+	def _remove_watch(self, path):
+		""" Stop watching a directory (not what is below it). """
+		if self._engine:
+			self._engine.remove_path(self, path)
+			return
+		self._register_lock.acquire()
+		try:
+			if not self._watch_manager or self._stopped_event.isSet():
+				return
+			wd = self._watch_manager.get_wd(path)
+			if wd is not None:
+				self._watch_manager.rm_watch(wd)
+				self._watches.pop(path, None)
+		finally:
+			self._register_lock.release()
+	
+	def _record(self, event):
+		""" With the trace option naming a file, record the events we
+		receive from the kernel, for t/replay.py to play back. Synthetic
+		events are not recorded; the replay makes them again. """
+		path = self._config.get('trace')
+		if self._trace and self._trace.path != path:
+			self._trace.close()
+			self._trace = None
+		if not path:
+			return
+		try:
+			if not self._trace:
+				self._trace = iTrace(path, self._path)
+			self._trace.record(event)
+		except IOError, data:
+			iWatchError(self._observer, "Watch: %s: Could not write trace '%s': %s" % (self._path, path, data))
+	
+	def _pass_on(self, event):
+		""" Dispatch an event, through the coalescer if we have one. """
+		if not self._coalescer:
+			self._dispatch_event(event)
+		elif not event.event_name.startswith('WATCH_'):
+			self._coalescer.push(event)
+		else:
+			# Our own events come after everything seen so far
+			self._flush_events(force=True)
+			self._dispatch_event(event)
+	
+	def _moved_event(self, event_name, event, **extra):
+		""" A synthetic event about the object of a move event """
+		attributes = {
+			'event_name': event_name,
+			'path': event.path,
+			'name': event.name,
+			'is_dir': getattr(event, 'is_dir', False),
+			'cookie': event.cookie,
+			'synthetic': True,
+		}
+		attributes.update(extra)
+		return pyinotify_Event(attributes)
+	
+	def _correlate_move(self, event):
+		""" With correlate_moves set, the two halves of a move are paired
+		by cookie and passed on as a single synthetic IN_MOVE event, its
+		path and name being the destination and src_path and src_name
+		the source. An IN_MOVED_FROM left alone for move_timeout_ms (500)
+		becomes an IN_DELETE and a lone IN_MOVED_TO an IN_CREATE. """
+		if event.event_name == 'IN_MOVED_FROM':
+			source = (event.path, event.name)
+			if self._move_sources.has_key(source):
+				self._expire_move(self._move_sources[source])
+			timeout = float(self._config.get('move_timeout_ms', 500)) / 1000
+			self._moves[event.cookie] = (event, time() + timeout)
+			self._move_sources[source] = event.cookie
+			return
+		
+		pending = self._moves.pop(event.cookie, None)
+		if not pending:
+			# Moved in from outside of the watch
+			self._pass_on(self._moved_event('IN_CREATE', event))
+			return
+		source = pending[0]
+		del self._move_sources[(source.path, source.name)]
+		self._pass_on(self._moved_event('IN_MOVE', event, src_path=source.path, src_name=source.name))
+	
+	def _expire_move(self, cookie):
+		""" A move's other half won't come: it left the watch. """
+		(event, deadline) = self._moves.pop(cookie)
+		del self._move_sources[(event.path, event.name)]
+		self._pass_on(self._moved_event('IN_DELETE', event))
+	
+	def _expire_moves(self, force=False):
+		""" Expire the moves waiting longer than allowed (all with force).
+		They all wait the same, so the oldest come first. """
+		now = time()
+		while self._moves:
+			cookie = iter(self._moves).next()
+			if not force and self._moves[cookie][1] > now:
+				break
+			self._expire_move(cookie)
+	
+	def _scan_new_directory(self, path):
+		""" A new directory was created and auto added. Anything put in it
+		before its watch was in place (mkdir -p, untar...) would never be
+		seen, so watch its subdirectories and report all its contents as
+		created, parents first. Watches of a level are added before it is
+		listed, so nothing falls in between; what shows up both in a
+		listing and as a real event is reported only once. """
+		now = time()
+		self._forget_synthesized(now)
+		
+		level = [path]
+		while level:
+			events = []
+			next_level = []
+			for directory in level:
 				try:
-					plugin.process_event(event)
-				except iPluginError, data:
-					iWatchError(self._observer, "Watch: %s: Plugin '%s' reported error: %s" % (self._path, plugin_name, data))
-					
+					names = os.listdir(directory)
+				except OSError:
+					# Gone already
+					continue
+				for name in names:
+					created = os.path.join(directory, name)
+					try:
+						is_dir = stat.S_ISDIR(os.lstat(created).st_mode)
+					except OSError:
+						continue
+					if self._filter and not self._filter.wanted(created, is_dir):
+						continue
+					if is_dir:
+						next_level.append(created)
+					events.append(pyinotify_Event(
+						{
+						'event_name': 'IN_CREATE',
+						'path': directory,
+						'name': name,
+						'is_dir': is_dir,
+						'cookie': 0,
+						'synthetic': True,
+						}
+					))
+			if next_level:
+				self._add_watches(next_level, rec=False)
+			for event in events:
+				created = os.path.join(event.path, event.name)
+				self._synthesized[created] = now
+				self._synthesized_order.append((now, created))
+				self.process_event(event)
+			level = next_level
+	
+	def _forget_synthesized(self, now):
+		""" Forget what was synthesized a while ago: its real events
+		have come by now, a later one is about something new. """
+		while self._synthesized_order and self._synthesized_order[0][0] < now - 5:
+			(time_stamp, created) = self._synthesized_order.popleft()
+			if self._synthesized.get(created) == time_stamp:
+				del self._synthesized[created]
+	
+	def _begin_batch(self):
+		""" Collect the events dispatched from now on, up to
+		_end_batch(), to deliver them together. """
+		if self._batch is None:
+			self._batch = []
+	
+	def _end_batch(self):
+		""" Deliver the events collected since _begin_batch(). """
+		(events, self._batch) = (self._batch, None)
+		if events:
+			self._deliver(events)
+	
+	def _dispatch_event(self, event):
+		""" Hand an event to each of our plugins, or keep it for
+		the batch being collected. """
+		if self._batch is None:
+			self._deliver([event])
+		elif event.event_name.startswith('WATCH_'):
+			# Keep the order: what came before goes first
+			(events, self._batch) = (self._batch, [])
+			events.append(event)
+			self._deliver(events)
+		else:
+			self._batch.append(event)
+	
+	def _event_mask(self, event):
+		# Our own WATCH_* events have no inotify code and go to everybody
+		if event.event_name == 'IN_MOVE':
+			# A correlated move goes to those wanting either half
+			return EventsCodes.IN_MOVED_FROM | EventsCodes.IN_MOVED_TO
+		return getattr(EventsCodes, event.event_name, 0)
+	
+	def _deliver(self, events):
+		""" Hand a list of events to each of our plugins: in one call
+		to those taking batches, one by one to the others. """
+		masks = [self._event_mask(event) for event in events]
+		
+		for (plugin_name, plugin, plugin_mask) in self._dispatch:
+			# Another plugin may have widened the watch mask.
+			# Don't bother those not interested in the event.
+			wanted = [event for (event, event_mask) in zip(events, masks)
+					if not event_mask or event_mask & plugin_mask]
+			batch = []
+			for event in wanted:
+				if event.event_name.startswith('WATCH_'):
+					self._deliver_to(plugin_name, plugin, batch)
+					batch = []
+					self._deliver_to(plugin_name, plugin, [event])
+				else:
+					batch.append(event)
+			self._deliver_to(plugin_name, plugin, batch)
+	
+	def _deliver_to(self, plugin_name, plugin, events):
+		""" Hand a list of events to a plugin, in one call if it
+		takes batches (a worker knows whether its plugin does). """
+		items = events
+		if len(events) > 1 and (isinstance(plugin, iPluginWorker) or hasattr(plugin, 'process_events')):
+			items = [events]
+		
+		for item in items:
+			# Process event
+			try:
+				if isinstance(plugin, iPluginWorker):
+					# Workers time and profile their plugins themselves
+					if isinstance(item, list):
+						plugin.process_events(item)
+					else:
+						plugin.process_event(item)
+				else:
+					self._call_plugin(plugin_name, plugin, item)
+			except iPluginError, data:
+				iWatchError(self._observer, "Watch: %s: Plugin '%s' reported error: %s" % (self._path, plugin_name, data))
+	
+	def _call_plugin(self, plugin_name, plugin, event):
+		""" Have a plugin process an event, or a list of them if it
+		takes batches, timing it and, if asked to, profiling it.
+		Called from the thread the plugin runs in. """
+		events = isinstance(event, list) and event or [event]
+		profile = None
+		if self._profiling:
+			(profile, lock) = self._profile(plugin_name)
+			lock.acquire()
+			profile.enable()
+		start = time()
+		try:
+			if isinstance(event, list):
+				plugin.process_events(event)
 			else:
-				iWatchError(self._observer, "Watch: %s: Required plugin '%s' is missing." % (self._path, plugin_name))
+				plugin.process_event(event)
+		finally:
+			duration = time() - start
+			if profile:
+				profile.disable()
+				lock.release()
+			# A batch is accounted evenly to its events
+			for item in events:
+				self._metrics.time_plugin(plugin_name, item, duration / len(events))
+			if self._slow_event and duration > self._slow_event:
+				if len(events) > 1:
+					print >>sys.stderr, "Watch: %s: Plugin '%s' took %.1f ms for a batch of %d events" % (self._path,
+						plugin_name, duration * 1000, len(events))
+				else:
+					print >>sys.stderr, "Watch: %s: Plugin '%s' took %.1f ms for %s on '%s'" % (self._path, plugin_name,
+						duration * 1000, events[0].event_name, os.path.join(events[0].path or '', getattr(events[0], 'name', None) or ''))
+	
+	def _profile(self, plugin_name):
+		""" The profile of a plugin, with the lock guarding it """
+		self._profiles_lock.acquire()
+		try:
+			if not self._profiles.has_key(plugin_name):
+				self._profiles[plugin_name] = (cProfile.Profile(), Lock())
+			return self._profiles[plugin_name]
+		finally:
+			self._profiles_lock.release()
+	
+	def configure_profiling(self):
+		""" Read profile_plugins and slow_event_ms from our config,
+		or else from the global one. Called again by the observer
+		when the global ones change. """
+		global_config = self._observer._config['global']
+		self._profiling = self._observer._is_true(
+			self._config.get('profile_plugins', global_config.get('profile_plugins', False)))
+		self._slow_event = float(self._config.get('slow_event_ms', global_config.get('slow_event_ms', 0))) / 1000
+	
+	def dump_profiles(self, directory):
+		""" Write the profile of each plugin profiled so far to
+		<directory>/<watch path>.<plugin>.prof (for pstats).
+		Returns the files written. """
+		self._profiles_lock.acquire()
+		try:
+			profiles = self._profiles.items()
+		finally:
+			self._profiles_lock.release()
+		written = []
+		for (plugin_name, (profile, lock)) in profiles:
+			path = os.path.join(directory, "%s.%s.prof" % (self._path.strip(os.sep).replace(os.sep, '_'), plugin_name))
+			lock.acquire()
+			try:
+				profile.dump_stats(path)
+			finally:
+				lock.release()
+			written.append(path)
+		return written
 	
 	def stop(self):
 		self._terminate_event.set()
+		if self._engine:
+			self._queue.put(None)
+		if not self._started:
+			# No run() to drop the regions our plugins got
+			self._cache.drop_regions(self)
 
 class iPollWatch(iWatch):
 	""" A watch using polling """
 	# Used only to watch our config file
 	# because vi causes some trouble otherwise.
 	# No recursion implemented!
-	def run(self):
+	_uses_engine = False
+	
+	def _run(self):
+		self._start_workers()
 		if not os.path.isfile(self._path):
 			iWatchError(self._observer, "Missing target or target is not a regular file!")
 		else:
@@ -385,8 +2164,106 @@ class iPollWatch(iWatch):
 			except:
 				iWatchError(self._observer, "Could not stat target!")
 
+class iRecursivePollWatch(iPollWatch):
+	""" A watch polling a whole tree, for filesystems where inotify
+	sees nothing (NFS, FUSE...). Each poll takes an iSnapshot of the
+	tree, listing again only the directories whose mtime has changed,
+	and passes on the differences from the previous one as IN_DELETE,
+	IN_CREATE, IN_MODIFY and IN_ATTRIB events, so the plugins work as
+	usual.
+	
+	The tree is polled every poll_min_interval_ms (1000) after a change,
+	and twice as long after each poll that found nothing, up to
+	poll_max_interval_ms (30000). To go easy on the filesystem, the
+	interval is also never less than ten times the last poll took. """
+	
+	def _poll(self, previous):
+		""" Take a new snapshot; pass on what has changed since previous.
+		Returns the snapshot and the events. """
+		snapshot = iSnapshot(self._path, self._filter)
+		snapshot.scan(previous)
+		events = []
+		if previous:
+			events = snapshot.diff(previous)
+			if not os.path.isdir(self._path):
+				# Gone (or unmounted): we are done
+				events.append(pyinotify_Event(
+					{
+					'event_name': 'IN_DELETE_SELF',
+					'path': self._path,
+					'name': None,
+					}
+				))
+		self._begin_batch()
+		try:
+			for event in events:
+				self.process_event(event)
+		finally:
+			self._end_batch()
+		self._progress['directories'] = snapshot.directories()
+		return (snapshot, events)
+	
+	def _next_interval(self, interval, changed, duration):
+		""" Seconds until the next poll, given the last interval, whether
+		the last poll found changes and how long it took. """
+		shortest = int(self._config.get('poll_min_interval_ms', 1000)) / 1000.0
+		longest = int(self._config.get('poll_max_interval_ms', 30000)) / 1000.0
+		if changed:
+			interval = shortest
+		else:
+			interval = min(interval * 2, longest)
+		return max(interval, shortest, duration * 10)
+	
+	def _run(self):
+		process_event = iProcessEvent(self)
+		
+		self._start_workers()
+		process_event.process_default(pyinotify_Event(
+			{
+			'event_name': 'WATCH_INIT',
+			'path': self._path
+			}
+		))
+		
+		if not os.path.isdir(self._path):
+			iWatchError(self._observer, "Error watching %s. Maybe file or directory don't exist?" % self._path)
+			return
+		try:
+			start = time()
+			(snapshot, events) = self._poll(None)
+			self._progress['done'] = True
+			interval = self._next_interval(0, True, time() - start)
+			due = time() + interval
+			while True:
+				# Wake up at least once a second for coalesced
+				# events and configuration changes
+				self._terminate_event.wait(min(max(0, due - time()), self._poll_timeout() / 1000.0))
+				if time() >= due and not self._terminate_event.isSet():
+					start = time()
+					(snapshot, events) = self._poll(snapshot)
+					interval = self._next_interval(interval, bool(events), time() - start)
+					due = time() + interval
+				if self._housekeeping(process_event):
+					break
+			
+			self._die(process_event)
+		except ValueError:
+			iWatchError(self._observer, "Watch %s: Bad poll_* option value." % self._path)
+		except:
+			iWatchError(self._observer, "Unknown error while watching %s." % self._path)
+
 class iObserver(iPlugin):
 	""" The main class. Runs in a separate thread. """
+
+	# As a plugin we only care about changes to the config file
+	# and the plugins directory.
+	mask = EventsCodes.IN_CREATE | EventsCodes.IN_DELETE | EventsCodes.IN_DELETE_SELF | \
+		EventsCodes.IN_MODIFY | EventsCodes.IN_MOVE_SELF | EventsCodes.IN_MOVED_FROM | \
+		EventsCodes.IN_MOVED_TO
+	
+	# Global options that are more than on/off: any change counts
+	_valued_globals = ('cache_max_entries', 'metrics_socket', 'slow_event_ms')
+
 	def __init__(self, config=None):
 		self._thread = Thread(target=self.run)
 		self._config = None
@@ -396,21 +2273,38 @@ class iObserver(iPlugin):
 		self._plugins_changed_event = Event()
 		self._terminate_event = Event()
 		self._error_event = Event()
+		# What the main thread sleeps on: 'stop', 'error', 'config', 'plugins'
+		self._notifications = Queue()
 		self._configure(config)
 		self._plugins = None
+		self._plugin_mtimes = {}
+		self._engine = None
+		self._metrics_server = None
 		self._watches = None
 		self._config_watch = None
 		self._plugins_watch = None
-		self._cache = iCache(max_age=10, expire_after_count=100)
+		self._cache = iCache(max_age=10, expire_after_count=100,
+			max_entries=int(self._config['global']['cache_max_entries']))
 		
 		self._load_plugins()
 	
+	def _notifier_engine(self):
+		""" Return the shared notifier engine new watches should use,
+		or None if each of them should have its own notifier. """
+		if not self._is_true(self._config['global']['shared_notifier']):
+			return None
+		if not self._engine:
+			self._engine = iNotifierEngine(self)
+			self._engine.start()
+		return self._engine
+	
 	def _notify_error(self, error):
 		# An exception rose somewhere in our threads.
 		# Maybe terminate or examine error?
 		if isinstance(error, iPublicError):
 			self._error = error
 			self._error_event.set()
+			self._notifications.put('error')
 	
 	def is_alive(self):
 		""" Check if we are in error state and dead/dying """
@@ -423,9 +2317,30 @@ class iObserver(iPlugin):
 		else:
 			return None
 	
+	def registration_progress(self):
+		""" For each watch: (directories watched so far, finished?) """
+		if not self._watches:
+			return {}
+		return dict([(path, watch.get_progress()) for (path, watch) in self._watches.items()])
+	
+	def get_metrics(self):
+		""" The metrics of all watches and of the cache """
+		watches = {}
+		if self._watches:
+			watches = dict([(path, watch.get_metrics()) for (path, watch) in self._watches.items()])
+		return {'watches': watches, 'cache': self._cache.get_stats()}
+	
+	def dump_profiles(self, directory):
+		""" Write the profiles of all watches' plugins (see the
+		profile_plugins option) to directory. Returns the files. """
+		written = []
+		for watch in (self._watches or {}).values():
+			written.extend(watch.dump_profiles(directory))
+		return written
+	
 	def _validate_config(self):
 		""" TODO: Sanity checks of the final config """
-		allowed_globals = "watch_plugins,watch_config".split(',')
+		allowed_globals = "watch_plugins,watch_config,shared_notifier,cache_max_entries,metrics_socket,profile_plugins,slow_event_ms".split(',')
 		for (key, val) in self._config['global'].iteritems():
 			if not key in allowed_globals:
 				if not self._thread.isAlive():
@@ -478,6 +2393,11 @@ class iObserver(iPlugin):
 			'global':{
 				'watch_config': False,
 				'watch_plugins': False,
+				'shared_notifier': False,
+				'cache_max_entries': 0,
+				'metrics_socket': False,
+				'profile_plugins': False,
+				'slow_event_ms': 0,
 			},
 			'watches':{
 			
@@ -539,6 +2459,26 @@ class iObserver(iPlugin):
 				if self._plugins_watch and self._plugins_watch.is_alive():
 					self._plugins_watch.stop()
 					self._plugins_watch = None
+		elif option == 'shared_notifier':
+			# Nothing to do now - watches started from now on
+			# will use (or not) the shared engine.
+			pass
+		elif option == 'cache_max_entries':
+			self._cache.set_max_entries(int(self._config['global'][option]))
+		elif option == 'metrics_socket':
+			path = self._config['global'][option]
+			if self._metrics_server and self._metrics_server.path != path:
+				self._metrics_server.stop()
+				self._metrics_server = None
+			if path and path not in ('no', 'false', 'off') and not self._metrics_server:
+				try:
+					self._metrics_server = iMetricsServer(self, path)
+				except socket.error, data:
+					iObserverError(self, "Could not serve metrics on '%s': %s" % (path, data))
+		elif option in ('profile_plugins', 'slow_event_ms'):
+			# Watches without options of their own follow the global ones
+			for watch in (self._watches or {}).values():
+				watch.configure_profiling()
 		else:
 			iObserverError(self, "_obey_global_option called with incorrect option '%s'" % option)
 	
@@ -549,7 +2489,9 @@ class iObserver(iPlugin):
 		
 		# See what's changed and what needs to be done:
 		for (option, value) in old_config['global'].iteritems():
-			if self._is_true(value) != self._is_true(self._config['global'][option]):
+			new_value = self._config['global'][option]
+			if self._is_true(value) != self._is_true(new_value) or \
+					(option in self._valued_globals and value != new_value):
 				self._obey_global_option(option)
 		
 		# Stop watches that were removed from config file
@@ -567,27 +2509,44 @@ class iObserver(iPlugin):
 		# Start any new watches
 		for watch in self._config['watches'].keys():
 			if not watch in self._watches.keys():
-				self._watches[watch] = iWatch(
-					observer=self,
-					available_plugins=self._plugins,
-					config={watch: self._config['watches'][watch]}
-				)
+				self._watches[watch] = self._new_watch(watch)
 				self._watches[watch].start()
 	
+	def _new_watch(self, path):
+		""" The watch of a configured path: an iWatch, or an
+		iRecursivePollWatch if it asks for polling. """
+		watch_class = iWatch
+		if self._is_true(self._config['watches'][path].get('poll', False)):
+			watch_class = iRecursivePollWatch
+		return watch_class(
+			observer=self,
+			available_plugins=self._plugins,
+			config={path: self._config['watches'][path]}
+		)
+	
 	def _load_plugins(self):
 		# Get a list of all plugins... (ignoring any names starting with _)
 		# TODO use a more readable expression like:
 		# [d for d in ... if ...]
 		#self._plugins = dict(map(lambda x: (os.path.basename(x)[:-3], None), glob(plugins.__path__[0] + '/[!_]*.py')))
 		
+		old_plugins = self._plugins or {}
 		self._plugins = dict([ (os.path.basename(x)[:-3], None)
 						for x in glob(plugins.__path__[0] + '/[!_]*.py') ])
+		changed = set(old_plugins.keys()) != set(self._plugins.keys())
 		
 		# and load any that are not yet loaded.
-		# Don't attempt to reload existing ones even if they might have changed,
-		# because I don't know what the consequences be:)
+		# Reload only the ones whose source has changed since last time,
+		# so that watches don't rebuild their plugins for nothing.
 		try: 
 			for plugin in self._plugins.keys():
+				mtime = os.stat(os.path.join(plugins.__path__[0], plugin + '.py')).st_mtime
+				if self._plugin_mtimes.get(plugin) == mtime and old_plugins.get(plugin):
+					self._plugins[plugin] = old_plugins[plugin]
+					continue
+				self._plugin_mtimes[plugin] = mtime
+				changed = True
+				
 				if not sys.modules.has_key('iobserver.plugins.'+plugin):
 					# Load new plugin
 					imp.acquire_lock()
@@ -599,13 +2558,15 @@ class iObserver(iPlugin):
 				
 				else:
 					# Reload plugin
-					reload(sys.modules['iobserver.plugins.'+plugin])
+					self._plugins[plugin] = reload(sys.modules['iobserver.plugins.'+plugin])
 		except Exception, data:
 			if imp.lock_held(): imp.release_lock()
 			if self._thread.isAlive():
 				iObserverError(self, "Could not load plugin(s): %s" % data)
 			else:
 				raise iObserverError(None, "Could not load plugin(s): %s" % data)
+		
+		return changed
 	
 	def process_event(self, event):
 		""" Having this method makes us a valid plugin:)
@@ -620,6 +2581,7 @@ class iObserver(iPlugin):
 		if event.path == self._config_path:
 			# Event is about the configuration file
 			self._config_changed_event.set()
+			self._notifications.put('config')
 		else:
 			# Event is about plugins directory
 			
@@ -637,6 +2599,7 @@ class iObserver(iPlugin):
 				# Ignore hidden files
 				return
 			self._plugins_changed_event.set()
+			self._notifications.put('plugins')
 	
 	def start(self):
 		""" Start our new thread. """
@@ -654,13 +2617,11 @@ class iObserver(iPlugin):
 		
 		self._obey_global_option('watch_plugins')
 		
+		self._obey_global_option('metrics_socket')
+		
 		# Set up all other configured watches
 		for watch in self._config['watches'].keys():
-			self._watches[watch] = iWatch(
-				observer=self,
-				available_plugins=self._plugins,
-				config={watch: self._config['watches'][watch]}
-			)
+			self._watches[watch] = self._new_watch(watch)
 		
 		# Fire in the hole!
 		for watch in self._watches.values():
@@ -670,8 +2631,10 @@ class iObserver(iPlugin):
 		#  - terminate event
 		#  - error
 		#  - configuration changed event
+		# Each of them is also put in the notifications queue,
+		# so we sleep until one of them comes.
 		while True:
-			self._terminate_event.wait(1)
+			self._notifications.get()
 			if self._terminate_event.isSet():
 				# Exiting
 				break
@@ -679,7 +2642,13 @@ class iObserver(iPlugin):
 				break
 			if self._plugins_changed_event.isSet():
 				self._plugins_changed_event.clear()
-				self._load_plugins()
+				if self._load_plugins():
+					# Let the watches pick up the reloaded plugins
+					for (path, watch) in self._watches.items():
+						watch.update_config(
+							available_plugins=self._plugins,
+							config={path: self._config['watches'][path]}
+						)
 			if self._config_changed_event.isSet():
 				self._config_changed_event.clear()
 				self._update_config()
@@ -691,7 +2660,16 @@ class iObserver(iPlugin):
 		
 		if self._config_watch: self._config_watch.stop()
 		if self._plugins_watch: self._plugins_watch.stop()
+		if self._engine: self._engine.stop()
+		if self._metrics_server: self._metrics_server.stop()
 		
 	def stop(self):
 		""" Called from application thread. """
-		self._terminate_event.set()
\ No newline at end of file
+		self._terminate_event.set()
+		self._notifications.put('stop')
+	
+	def wait(self, timeout=None):
+		""" Block until we are dead (stopped or killed by an error),
+		at most timeout seconds. Returns True if we are dead. """
+		self._thread.join(timeout)
+		return not self._thread.isAlive()
\ No newline at end of file
@@ -1,11 +1,300 @@
-from iobserver import iPluginError, iPlugin
+from iobserver import iPluginError, iPlugin, EventsCodes, pyinotify_Event
+from threading import Thread, Condition, Lock
+from collections import OrderedDict
+from hashlib import md5
+import sqlite3
+import ctypes
+import ctypes.util
+import fcntl
+import errno
 import shutil
+import stat
 import os.path
 import os
 import copy
 
+# Kernel side copying (Linux). Python 2 has no os.sendfile or
+# os.copy_file_range, so they are called from libc directly.
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, xfs...)
+FICLONE = 0x40049409
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+	_libc = None
+
+# Errors meaning a strategy can't work here, as opposed to a failed copy
+_unsupported_errors = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM)
+
+def _libc_function(name, argtypes):
+	function = getattr(_libc, name, None)
+	if not function:
+		raise OSError(errno.ENOSYS, "%s() is not available" % name)
+	function.restype = ctypes.c_ssize_t
+	function.argtypes = argtypes
+	return function
+
+def _copy_loop(call, size, source_fd, destination_fd):
+	""" Call call(count) until size bytes are copied. If it stops
+	copying before that, the rest is copied through a buffer. """
+	copied = 0
+	while copied < size:
+		count = call(min(size - copied, 1 << 30))
+		if count < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		if count == 0:
+			# Both offsets have moved on with what was copied
+			buffer_copy(source_fd, destination_fd, size - copied)
+			return
+		copied += count
+
+def reflink_copy(source_fd, destination_fd, size):
+	fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+def copy_file_range_copy(source_fd, destination_fd, size):
+	function = _libc_function('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+	_copy_loop(lambda count: function(source_fd, None, destination_fd, None, count, 0), size, source_fd, destination_fd)
+
+def sendfile_copy(source_fd, destination_fd, size):
+	function = _libc_function('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+	_copy_loop(lambda count: function(destination_fd, source_fd, None, count), size, source_fd, destination_fd)
+
+def buffer_copy(source_fd, destination_fd, size):
+	while True:
+		data = os.read(source_fd, 1 << 20)
+		if not data:
+			break
+		os.write(destination_fd, data)
+
+# In order of preference
+copy_strategies = [
+	('reflink', reflink_copy),
+	('copy_file_range', copy_file_range_copy),
+	('sendfile', sendfile_copy),
+	('buffer', buffer_copy),
+]
+
+class CopyPool(object):
+	""" Runs mirror operations in worker threads, off the watch thread.
+	An operation waits for all earlier ones on the same path or on a
+	parent or child of it; unrelated paths are handled in parallel. """
+	def __init__(self, workers):
+		self._condition = Condition()
+		self._queue = []
+		self._running = []
+		self._errors = []
+		self._stopping = False
+		self._threads = [Thread(target=self._work) for i in range(workers)]
+		for thread in self._threads:
+			thread.setDaemon(True)
+			thread.start()
+	
+	def size(self):
+		return len(self._threads)
+	
+	def submit(self, paths, function, *args):
+		""" Queue function(*args), touching the given mirror paths. """
+		self._condition.acquire()
+		self._queue.append((paths, function, args))
+		self._condition.notifyAll()
+		self._condition.release()
+	
+	def add(self, counters, key, amount):
+		""" counters[key] += amount, with the workers possibly
+		counting at the same time. """
+		self._condition.acquire()
+		try:
+			counters[key] = counters.get(key, 0) + amount
+		finally:
+			self._condition.release()
+	
+	def _parents(self, path):
+		while True:
+			parent = os.path.dirname(path)
+			if parent == path:
+				return
+			yield parent
+			path = parent
+	
+	def _claim(self, paths, claimed, covered):
+		""" Note paths as taken: in claimed, and the directories
+		above them in covered. """
+		for path in paths:
+			claimed.add(path)
+			for parent in self._parents(path):
+				if parent in covered:
+					break
+				covered.add(parent)
+	
+	def _conflict(self, paths, claimed, covered):
+		""" True if any of paths is taken, or is below or above
+		something taken. """
+		for path in paths:
+			if path in claimed or path in covered:
+				return True
+			for parent in self._parents(path):
+				if parent in claimed:
+					return True
+		return False
+	
+	def _next(self):
+		""" Take the first queued task that may run now, if any:
+		one not touching the paths of a running task or of a task
+		queued before it. Called with the lock held. """
+		claimed = set()
+		covered = set()
+		for paths in self._running:
+			self._claim(paths, claimed, covered)
+		for (index, task) in enumerate(self._queue):
+			if not self._conflict(task[0], claimed, covered):
+				self._queue.pop(index)
+				self._running.append(task[0])
+				return task
+			self._claim(task[0], claimed, covered)
+		return None
+	
+	def _work(self):
+		while True:
+			self._condition.acquire()
+			task = self._next()
+			while not task:
+				if self._stopping and not self._queue:
+					self._condition.release()
+					return
+				self._condition.wait()
+				task = self._next()
+			self._condition.release()
+			
+			(paths, function, args) = task
+			try:
+				function(*args)
+			except Exception, data:
+				self._condition.acquire()
+				self._errors.append(str(data))
+				self._condition.release()
+			
+			self._condition.acquire()
+			self._running.remove(paths)
+			self._condition.notifyAll()
+			self._condition.release()
+	
+	def pop_errors(self):
+		""" Return (and forget) the errors of finished operations. """
+		self._condition.acquire()
+		errors = self._errors
+		self._errors = []
+		self._condition.release()
+		return errors
+	
+	def drain(self):
+		""" Wait for all queued operations to finish. """
+		self._condition.acquire()
+		while self._queue or self._running:
+			self._condition.wait()
+		self._condition.release()
+	
+	def stop(self):
+		""" Finish all queued operations and stop the workers. """
+		self._condition.acquire()
+		self._stopping = True
+		self._condition.notifyAll()
+		self._condition.release()
+		for thread in self._threads:
+			thread.join()
+
+class Manifest(object):
+	""" An on-disk (sqlite) record of what is in the mirror: path
+	relative to the watch, size, mtime and optionally a hash of each
+	entry. Lets a restart compare the source with the manifest instead
+	of looking at every file in the mirror. """
+	def __init__(self, path):
+		self.path = path
+		self._lock = Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		# Paths are byte strings
+		self._db.text_factory = str
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=NORMAL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, is_dir INTEGER, size INTEGER, mtime REAL, hash TEXT)")
+		self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		self._db.commit()
+	
+	def _subtree(self, path):
+		""" WHERE clause and arguments matching path and all below it. """
+		return ("path = ? OR (path >= ? AND path < ?)", (path, path + '/', path + '0'))
+	
+	def _execute(self, statements):
+		""" Run (sql, arguments) statements in a single transaction. """
+		self._lock.acquire()
+		try:
+			try:
+				for (sql, arguments) in statements:
+					self._db.execute(sql, arguments)
+				self._db.commit()
+			except:
+				self._db.rollback()
+				raise
+		finally:
+			self._lock.release()
+	
+	def get_meta(self, key):
+		self._lock.acquire()
+		try:
+			row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+		finally:
+			self._lock.release()
+		if row:
+			return row[0]
+		return None
+	
+	def set_meta(self, key, value):
+		self._execute([("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))])
+	
+	def entries(self):
+		""" Return a dict: path -> (is_dir, size, mtime, hash) """
+		self._lock.acquire()
+		try:
+			return dict([(row[0], row[1:]) for row in self._db.execute("SELECT * FROM entries")])
+		finally:
+			self._lock.release()
+	
+	def record(self, entries):
+		""" Add or update (path, is_dir, size, mtime, hash) entries. """
+		self._execute([("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", entry) for entry in entries])
+	
+	def forget(self, path):
+		""" Remove path and everything below it. """
+		(where, arguments) = self._subtree(path)
+		self._execute([("DELETE FROM entries WHERE " + where, arguments)])
+	
+	def move(self, old_path, new_path):
+		(old_where, old_arguments) = self._subtree(old_path)
+		(new_where, new_arguments) = self._subtree(new_path)
+		self._execute([
+			("DELETE FROM entries WHERE " + new_where, new_arguments),
+			("UPDATE entries SET path = ? || substr(path, ?) WHERE " + old_where,
+				(new_path, len(old_path) + 1) + old_arguments),
+		])
+	
+	def clear(self):
+		self._execute([("DELETE FROM entries", ())])
+	
+	def close(self):
+		self._lock.acquire()
+		self._db.close()
+		self._lock.release()
+
 class Replica(iPlugin):
 	""" Mirror the watched directory. """
+
+	# Reads (access, open, close) don't change anything in the mirror
+	mask = EventsCodes.IN_ATTRIB | EventsCodes.IN_CREATE | EventsCodes.IN_DELETE | \
+		EventsCodes.IN_MODIFY | EventsCodes.IN_MOVED_FROM | EventsCodes.IN_MOVED_TO
+	
+	outputs = ('replica_destination', 'replica_manifest')
+
 	def __init__(self, *args, **kwargs):
 		self._events = {
 			'IN_ATTRIB': self._copy_stat,
@@ -14,6 +303,7 @@ class Replica(iPlugin):
 			'IN_MODIFY': self._copy,
 			'IN_MOVED_FROM': self._prepare_move,
 			'IN_MOVED_TO': self._copy,
+			'IN_MOVE': None,
 			'WATCH_INIT': self._init_mirror,
 			'WATCH_DEAD': None,
 			'WATCH_RECONFIG': None,
@@ -23,9 +313,28 @@ class Replica(iPlugin):
 	def _init_mirror(self, event):
 		""" First event ever - do first time sync. """
 		try:
-			if os.path.exists(self._config['replica_destination']):
-				self._delete_target(self._config['replica_destination'])
-			shutil.copytree(self._watch.get_path(), self._config['replica_destination'])
+			manifest = self._get_manifest()
+			destination = self._full_path(self._config['replica_destination'])
+			if manifest and manifest.get_meta('destination') != destination:
+				# The manifest describes some other mirror
+				manifest.clear()
+				manifest.set_meta('destination', destination)
+			
+			if self._config.get('replica_init', 'copy') == 'sync':
+				stats = self.get_stats()
+				for key in ('sync_scanned', 'sync_copied', 'sync_deleted'):
+					stats[key] = 0
+				if manifest and os.path.isdir(destination) and manifest.entries():
+					self._sync_from_manifest(manifest, stats)
+					return
+				self._sync_mirror(self._watch.get_path(), self._config['replica_destination'], stats)
+			else:
+				if os.path.exists(self._config['replica_destination']):
+					self._delete_target(self._config['replica_destination'])
+				shutil.copytree(self._watch.get_path(), self._config['replica_destination'], ignore=self._ignored)
+			
+			if manifest:
+				self._rebuild_manifest(manifest)
 		except iPluginError:
 			raise
 		except (IOError, shutil.Error), data:
@@ -35,28 +344,223 @@ class Replica(iPlugin):
 		except:
 			raise iPluginError("Unexpected error while creating initial mirror.")
 	
+	def _wanted(self, path, is_dir=None):
+		""" True unless the include/exclude patterns of the watch leave
+		path out. Left out entries are not mirrored at all. """
+		path_filter = getattr(self._watch, '_filter', None)
+		if not path_filter:
+			return True
+		if is_dir is None:
+			is_dir = os.path.isdir(path) and not os.path.islink(path)
+		return path_filter.wanted(path, is_dir)
+	
+	def _ignored(self, directory, names):
+		""" The names shutil.copytree should leave out """
+		return [name for name in names if not self._wanted(os.path.join(directory, name))]
+	
+	def _walk(self, top):
+		""" os.walk, without what the watch leaves out """
+		for (path, dirnames, filenames) in os.walk(top):
+			dirnames[:] = [name for name in dirnames if self._wanted(os.path.join(path, name))]
+			filenames[:] = [name for name in filenames if self._wanted(os.path.join(path, name), False)]
+			yield (path, dirnames, filenames)
+	
+	def _sync_mirror(self, source, destination, stats):
+		""" Bring an existing mirror up to date: walk both trees side by
+		side, copy only the files that differ and delete only what is not
+		in the source. Progress is counted in stats as we go. """
+		if not os.path.isdir(destination) or os.path.islink(destination):
+			if os.path.lexists(destination):
+				os.unlink(destination)
+			os.mkdir(destination)
+		
+		source_names = [name for name in os.listdir(source)
+				if self._wanted(os.path.join(source, name))]
+		for name in set(os.listdir(destination)).difference(source_names):
+			self._delete_target(os.path.join(destination, name))
+			stats['sync_deleted'] += 1
+		
+		for name in sorted(source_names):
+			source_path = os.path.join(source, name)
+			destination_path = os.path.join(destination, name)
+			try:
+				source_stat = os.lstat(source_path)
+			except OSError:
+				# Gone already - the events will tell
+				continue
+			if stat.S_ISLNK(source_stat.st_mode):
+				# Links are not mirrored (and may loop)
+				continue
+			stats['sync_scanned'] += 1
+			
+			if stat.S_ISDIR(source_stat.st_mode):
+				self._sync_mirror(source_path, destination_path, stats)
+				continue
+			if not stat.S_ISREG(source_stat.st_mode):
+				continue
+			
+			try:
+				destination_stat = os.lstat(destination_path)
+			except OSError:
+				destination_stat = None
+			if destination_stat and not stat.S_ISREG(destination_stat.st_mode):
+				self._delete_target(destination_path)
+				destination_stat = None
+			if not destination_stat or self._differs(source_path, source_stat, destination_path, destination_stat):
+				self._copy_file(source_path, destination_path)
+				stats['sync_copied'] += 1
+		
+		# Last, as filling the directory changes its times
+		shutil.copystat(source, destination)
+	
+	def _sync_from_manifest(self, manifest, stats):
+		""" Like _sync_mirror, but trust the manifest about the state of
+		the mirror, so that only the source has to be scanned. """
+		known = manifest.entries()
+		seen = set()
+		updates = []
+		# Source directories whose mirror needs its metadata refreshed
+		touched = set()
+		directories = []
+		watch_path = self._watch.get_path()
+		hashed = self._watch._observer._is_true(self._config.get('replica_sync_hash', False))
+		
+		for (path, dirnames, filenames) in self._walk(watch_path):
+			for name in dirnames + filenames:
+				source = os.path.join(path, name)
+				if os.path.islink(source):
+					# Not mirrored, as in _sync_mirror
+					continue
+				entry = self._manifest_entry(source, hashed=False)
+				if not entry:
+					continue
+				stats['sync_scanned'] += 1
+				relative = entry[0]
+				seen.add(relative)
+				known_entry = known.get(relative)
+				destination = self._form_destination(source)
+				
+				if entry[1]:
+					directories.append((source, destination))
+					if known_entry and known_entry[0] and known_entry[2] == entry[3]:
+						continue
+					if os.path.lexists(destination) and not os.path.isdir(destination):
+						self._delete_target(destination)
+					if not os.path.exists(destination):
+						os.mkdir(destination)
+					touched.add(source)
+					touched.add(path)
+					continue
+				
+				if known_entry and not known_entry[0] and known_entry[1] == entry[2]:
+					if hashed and known_entry[3]:
+						if known_entry[3] == self._file_hash(source):
+							continue
+					elif abs(known_entry[2] - entry[3]) <= 0.001:
+						continue
+				if os.path.isdir(destination):
+					self._delete_target(destination)
+				self._copy_file(source, destination)
+				updates.append(self._manifest_entry(source) or entry)
+				touched.add(path)
+				stats['sync_copied'] += 1
+		
+		# Whatever the manifest has, but the source hasn't, goes away
+		missing = set(known.keys()).difference(seen)
+		for relative in sorted(missing):
+			if os.path.dirname(relative) in missing:
+				# Went away with its parent
+				continue
+			self._delete_target(os.path.join(self._config['replica_destination'], relative))
+			manifest.forget(relative)
+			touched.add(os.path.dirname(os.path.join(watch_path, relative)))
+			stats['sync_deleted'] += 1
+		
+		# Deepest first, as filling a directory changes its times
+		directories.reverse()
+		for (source, destination) in directories + [(watch_path, self._config['replica_destination'])]:
+			if source in touched:
+				shutil.copystat(source, destination)
+				if source != watch_path:
+					updates.append(self._manifest_entry(source))
+		
+		manifest.record([entry for entry in updates if entry])
+	
+	def _rebuild_manifest(self, manifest):
+		""" Record the whole source tree as mirrored. """
+		entries = []
+		for (path, dirnames, filenames) in self._walk(self._watch.get_path()):
+			for name in dirnames + filenames:
+				entry = self._manifest_entry(os.path.join(path, name))
+				if entry:
+					entries.append(entry)
+		manifest.clear()
+		manifest.record(entries)
+	
+	def _differs(self, source, source_stat, destination, destination_stat):
+		""" Check if a mirrored file is out of date: by size and mtime,
+		and by content if replica_sync_hash is set. """
+		if source_stat.st_size != destination_stat.st_size:
+			return True
+		if self._watch._observer._is_true(self._config.get('replica_sync_hash', False)):
+			return self._file_hash(source) != self._file_hash(destination)
+		# copystat keeps only microseconds
+		return abs(source_stat.st_mtime - destination_stat.st_mtime) > 0.001
+	
+	def _file_hash(self, path):
+		digest = md5()
+		hashed = open(path, 'rb')
+		try:
+			while True:
+				data = hashed.read(1 << 20)
+				if not data:
+					break
+				digest.update(data)
+		finally:
+			hashed.close()
+		return digest.hexdigest()
+	
 	def _prepare_move(self, event):
 		""" Prepare a move from a MOVED_FROM event. """
 		# An object was moved out. Wait to see if the next
 		# event that we'll get is going to be an IN_MOVED_TO one.
-		self._cache.push('mirror_' + self._watch.get_path(), event)
+		self._region.push('move', event)
 	
 	def _finish_move(self, event, cached_event=None):
-		""" A matching MOVED_TO event received - do the move. """
+		""" A matching MOVED_TO event received - do the move. If the
+		source isn't mirrored (yet), as when a file is created and renamed
+		at once, copy the destination instead. """
+		source = self._form_destination(os.path.join(cached_event.path, cached_event.name))
+		destination = self._form_destination(os.path.join(event.path, event.name))
 		try:
-			source = os.path.join(cached_event.path, cached_event.name)
-			source = self._form_destination(source)
-			destination = os.path.join(event.path, event.name)
-			destination = self._form_destination(destination)
+			if not os.path.lexists(source):
+				self._copy_moved(event)
+				return
 			shutil.move(source, destination)
-		except shutil.Error, data:
-			raise iPluginError("Error moving '%s' to '%s'." % (source, destination))
+			manifest = self._get_manifest()
+			if manifest:
+				manifest.move(self._relative_path(os.path.join(cached_event.path, cached_event.name)),
+					self._relative_path(os.path.join(event.path, event.name)))
+		except (shutil.Error, IOError, OSError), data:
+			raise iPluginError("Error moving '%s' to '%s': %s" % (source, destination, data))
+	
+	def _copy_moved(self, event):
+		""" Mirror what was moved in place of event, with its contents
+		if it is a directory. """
+		watched = os.path.join(event.path, event.name)
+		if not getattr(event, 'is_dir', False):
+			self._copy(event)
+		elif os.path.isdir(watched):
+			shutil.copytree(watched, self._form_destination(watched), symlinks=True, ignore=self._ignored)
+			self._record(watched)
 	
 	def _delete(self, event):
 		""" Delete the object specified by the event. """
 		target = os.path.join(event.path, event.name)
-		target = self._form_destination(target)
-		self._delete_target(target)
+		self._delete_target(self._form_destination(target))
+		manifest = self._get_manifest()
+		if manifest:
+			manifest.forget(self._relative_path(target))
 		
 	def _delete_target(self, target):
 		""" Delete target file/directory. """
@@ -100,7 +604,7 @@ class Replica(iPlugin):
 		result = os.path.join(self._config['replica_destination'], result)
 		return result
 	
-	def _copy(self, event):
+	def _copy(self, event, entries=None):
 		""" Copy file from watched dir to target mirror """
 		source = os.path.join(event.path, event.name)
 		destination = self._form_destination(source)
@@ -111,7 +615,8 @@ class Replica(iPlugin):
 				os.mkdir(destination)
 				shutil.copystat(source, destination)
 			else:
-				shutil.copy2(source, destination)
+				self._copy_file(source, destination)
+			self._record(source, entries)
 		#except (shutil.Error, OSError), data:
 			#raise iPluginError("Error creating %s: %s." % (destination, data))
 		#except Exception, data:
@@ -122,15 +627,268 @@ class Replica(iPlugin):
 			# Then the error should be just ignored - the file no longer exists anyway.
 			pass
 	
-	def _copy_stat(self, event):
+	def _copy_file(self, source, destination):
+		""" Copy a regular file to the mirror, in delta mode
+		touching only what has changed. """
+		if self._config.get('replica_mode', 'full') == 'delta' and os.path.isfile(destination):
+			try:
+				written = self._delta_copy(source, destination)
+				self._count('delta_written', written)
+				self._count('delta_saved', os.path.getsize(destination) - written)
+				return
+			except (IOError, OSError):
+				# Fall back to a full copy
+				pass
+		self._full_copy(source, destination)
+	
+	def _full_copy(self, source, destination):
+		""" Copy a file with the best strategy that works here (see
+		replica_copy) and copy its metadata. The strategy used and the
+		ones found not to work are kept in the stats of the watch. """
+		wanted = self._config.get('replica_copy', 'auto')
+		if not wanted in ['auto', 'copy2'] + [name for (name, function) in copy_strategies]:
+			raise iPluginError("Unknown replica_copy '%s'." % wanted)
+		if wanted == 'copy2':
+			shutil.copy2(source, destination)
+			return
+		
+		stats = self.get_stats()
+		strategies = [(name, function) for (name, function) in copy_strategies
+				if (wanted == 'auto' or name == wanted) and not name in stats['copy_unsupported']]
+		if not strategies or strategies[-1] != copy_strategies[-1]:
+			# Plain copying through a buffer always works
+			strategies.append(copy_strategies[-1])
+		
+		source_fd = os.open(source, os.O_RDONLY)
+		try:
+			destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+			try:
+				size = os.fstat(source_fd).st_size
+				for (name, function) in strategies:
+					try:
+						function(source_fd, destination_fd, size)
+					except (IOError, OSError), data:
+						if not data.errno in _unsupported_errors or name == strategies[-1][0]:
+							raise
+						# Try the next one from the start
+						stats['copy_unsupported'].append(name)
+						os.ftruncate(destination_fd, 0)
+						os.lseek(destination_fd, 0, 0)
+						os.lseek(source_fd, 0, 0)
+						continue
+					stats['copy_strategy'] = name
+					self._count(name, counters=stats['copy_counts'])
+					break
+			finally:
+				os.close(destination_fd)
+		finally:
+			os.close(source_fd)
+		shutil.copystat(source, destination)
+	
+	def _delta_copy(self, source, destination):
+		""" Compare source and its existing mirror copy block by block,
+		rewriting only the blocks that differ and truncating or extending
+		the copy to the size of the source. Returns the bytes written. """
+		block_size = int(self._config.get('replica_block_size', 65536))
+		written = 0
+		offset = 0
+		src = open(source, 'rb')
+		try:
+			dst = open(destination, 'r+b')
+			try:
+				while True:
+					data = src.read(block_size)
+					if not data:
+						break
+					if dst.read(len(data)) != data:
+						dst.seek(offset)
+						dst.write(data)
+						written += len(data)
+					offset += len(data)
+					# Needed when switching between writing and reading
+					dst.seek(offset)
+				dst.truncate(offset)
+			finally:
+				dst.close()
+		finally:
+			src.close()
+		shutil.copystat(source, destination)
+		return written
+	
+	def get_stats(self):
+		""" Counters of this watch's mirror: the bytes written by delta
+		copies and the bytes they didn't have to write, the progress
+		of the last incremental sync and the copy strategies used. """
+		stats = self._region.get('stats')
+		if not stats:
+			stats = {}
+			self._region.push('stats', stats, True)
+		for counter in ('delta_written', 'delta_saved', 'sync_scanned', 'sync_copied', 'sync_deleted'):
+			stats.setdefault(counter, 0)
+		stats.setdefault('copy_strategy', None)
+		stats.setdefault('copy_counts', {})
+		stats.setdefault('copy_unsupported', [])
+		return stats
+	
+	def _count(self, counter, amount=1, counters=None):
+		""" Add to a counter of the stats (or of counters, a dict in
+		them), under the lock of the pool if we have one, as its
+		workers count too. """
+		if counters is None:
+			counters = self.get_stats()
+		pool = self._region.get('pool')
+		if pool:
+			pool.add(counters, counter, amount)
+		else:
+			counters[counter] = counters.get(counter, 0) + amount
+	
+	def _get_pool(self):
+		""" Return the worker pool of this watch (shared by all instances
+		of the plugin), or None if operations run inline. """
+		workers = int(self._config.get('replica_workers', 0))
+		pool = self._region.get('pool')
+		if pool and pool.size() != workers:
+			self._stop_pool()
+			pool = None
+		if not pool and workers > 0:
+			pool = CopyPool(workers)
+			self._region.push('pool', pool, True)
+		return pool
+	
+	def _stop_pool(self):
+		""" Let queued operations finish and drop the pool. """
+		pool = self._region.pop('pool')
+		if pool:
+			pool.stop()
+			self._check_pool(pool)
+	
+	def _check_pool(self, pool):
+		""" Report what went wrong in the workers since last time. """
+		errors = pool.pop_errors()
+		if errors:
+			raise iPluginError("; ".join(errors))
+	
+	def _get_manifest(self):
+		""" Return the manifest of this watch, if 'replica_manifest' names
+		one. Shared by all instances of the plugin, like the pool. """
+		manifest = self._region.get('manifest')
+		path = self._config.get('replica_manifest')
+		if manifest and manifest.path != path:
+			self._close_manifest()
+			manifest = None
+		if not manifest and path:
+			try:
+				manifest = Manifest(path)
+			except sqlite3.Error, data:
+				raise iPluginError("Could not open manifest '%s': %s" % (path, data))
+			self._region.push('manifest', manifest, True)
+		return manifest
+	
+	def _close_manifest(self):
+		manifest = self._region.pop('manifest')
+		if manifest:
+			manifest.close()
+	
+	def _relative_path(self, path):
+		""" Path of a watched item relative to the watch - the manifest key. """
+		return os.path.relpath(self._full_path(path), self._full_path(self._watch.get_path()))
+	
+	def _manifest_entry(self, source, hashed=True):
+		""" Return the manifest entry for a source path (None if gone). """
+		try:
+			source_stat = os.stat(source)
+		except OSError:
+			return None
+		is_dir = stat.S_ISDIR(source_stat.st_mode)
+		digest = None
+		if hashed and not is_dir and self._watch._observer._is_true(self._config.get('replica_sync_hash', False)):
+			digest = self._file_hash(source)
+		return (self._relative_path(source), int(is_dir), source_stat.st_size, source_stat.st_mtime, digest)
+	
+	def _record(self, source, entries=None):
+		""" Note in the manifest (if any) that source is now mirrored,
+		or add its entry to entries, to be noted later with others. """
+		manifest = self._get_manifest()
+		if manifest:
+			entry = self._manifest_entry(source)
+			if entry and entries is not None:
+				entries.append(entry)
+			elif entry:
+				manifest.record([entry])
+	
+	def _mirror_path(self, event):
+		""" The mirror path an event is about, used to order operations. """
+		if event.event_name.startswith('WATCH_'):
+			return self._full_path(self._config['replica_destination'])
+		return self._full_path(self._form_destination(os.path.join(event.path, event.name)))
+	
+	def _run(self, events, function, *args):
+		""" Run an operation concerning the given events,
+		in the pool if we have one. """
+		pool = self._get_pool()
+		if pool:
+			pool.submit([self._mirror_path(event) for event in events], function, *args)
+		else:
+			function(*args)
+	
+	def _copy_stat(self, event, entries=None):
 		source = os.path.join(event.path, event.name)
 		destination = self._form_destination(source)
 		try:
 			shutil.copystat(source, destination)
+			self._record(source, entries)
 		except:
 			# Again - assume that we failed because source was missing...
 			pass
 	
+	def _update_group(self, operations):
+		""" Run the (function, event) copies and stat updates of a
+		directory, noting them all in the manifest in one transaction. """
+		entries = []
+		try:
+			for (function, event) in operations:
+				function(event, entries)
+		finally:
+			if entries:
+				self._get_manifest().record(entries)
+	
+	def _run_groups(self, groups):
+		""" Run the operations gathered per directory by process_events """
+		for operations in groups.values():
+			operations = operations.values()
+			self._run([event for (function, event) in operations], self._update_group, operations)
+		groups.clear()
+	
+	def process_events(self, events):
+		""" Handle a batch of events. Copies and stat updates only read
+		the current state of their source, so those of a directory are
+		gathered into one operation (one pool task, one manifest
+		transaction) and each object is updated once, even if it was
+		written many times. Any other event is handled in order, once
+		what came before it is under way. """
+		if not self._config.has_key('replica_destination'):
+			# Bad config!
+			raise iPluginError("Missing replica_destination directive.")
+		
+		# directory -> name -> (function, event)
+		groups = OrderedDict()
+		for event in events:
+			function = self._events.get(event.event_name)
+			if function in (self._copy, self._copy_stat) and not self._region.get('move'):
+				operations = groups.setdefault(event.path, OrderedDict())
+				previous = operations.get(event.name)
+				# A copy updates the metadata too
+				if not previous or previous[0] == self._copy_stat and function == self._copy:
+					operations[event.name] = (function, event)
+			else:
+				self._run_groups(groups)
+				self.process_event(event)
+		self._run_groups(groups)
+		
+		pool = self._region.get('pool')
+		if pool:
+			self._check_pool(pool)
+	
 	def process_event(self, event):
 		if not self._config.has_key('replica_destination'):
 			# Bad config!
@@ -138,25 +896,50 @@ class Replica(iPlugin):
 			return
 		
 		if event.event_name == 'WATCH_INIT':
-			self._cache.push('mirror_config_' + self._watch.get_path(), self._config, True)
+			self._region.push('config', self._config, True)
 		elif event.event_name == 'WATCH_RECONFIG':
 			# Configuration might have changed!
-			cached_config = self._cache.get('mirror_config_' + self._watch.get_path())
-			if cached_config['replica_destination'] != self._config['mirror_destination']:
+			cached_config = self._region.get('config')
+			if cached_config['replica_destination'] != self._config['replica_destination']:
 				# Our target has changed - reinit
-				self._cache.push('mirror_config_' + self._watch.get_path(), self._config, True)
-				self._init_mirror(event)
+				self._region.push('config', self._config, True)
+				self._run([event], self._init_mirror, event)
 	
 		if self._events.has_key(event.event_name):
 			# Check if we have a delayed move event:
-			cached_event = self._cache.pop('mirror_'+self._watch.get_path())
+			cached_event = self._region.pop('move')
 			if cached_event and event.event_name == 'IN_MOVED_TO' and event.cookie == cached_event.cookie:
 				# A matching MOVE event
-				self._finish_move(event, cached_event)
+				self._run([cached_event, event], self._finish_move, event, cached_event)
 				return
 			elif cached_event:
 				# Not a matching event - object should be deleted
-				self._delete(cached_event)
+				self._run([cached_event], self._delete, cached_event)
 			
-			if self._events[event.event_name]:
-				self._events[event.event_name](event)
+			if event.event_name == 'IN_MOVED_FROM':
+				# Only remembers the event, no need for a worker
+				self._prepare_move(event)
+			elif event.event_name == 'IN_MOVE':
+				# Already paired by the watch
+				source = pyinotify_Event({
+					'event_name': 'IN_MOVED_FROM',
+					'mask': EventsCodes.IN_MOVED_FROM,
+					'path': event.src_path,
+					'name': event.src_name,
+					'is_dir': getattr(event, 'is_dir', False),
+					'cookie': getattr(event, 'cookie', 0),
+				})
+				self._run([source, event], self._finish_move, event, source)
+			elif self._events[event.event_name]:
+				self._run([event], self._events[event.event_name], event)
+		
+		if event.event_name == 'WATCH_DEAD':
+			# Don't leave anything half done behind us
+			try:
+				self._stop_pool()
+			finally:
+				self._close_manifest()
+		else:
+			pool = self._region.get('pool')
+			if pool:
+				self._check_pool(pool)
@@ -1,10 +1,277 @@
-from iobserver import iPlugin, iPluginError
+from iobserver import iPlugin, iPluginError, EventsCodes
+from threading import Thread, Lock, Event
+from Queue import Queue, Empty
+from time import time
+import os
 import os.path
+import sys
 import datetime
+import struct
+import json
+
+# Records handed to the writers: (time, event name, mask, path, name,
+# cookie, is_dir, message, source) - the source of a correlated move
+
+def format_text(record):
+	""" The human readable sentence """
+	return "%s %s\n" % (datetime.datetime.fromtimestamp(record[0]), record[7])
+
+def _text(value):
+	""" Names are bytes in whatever encoding the file system uses,
+	take them as UTF-8 and replace what is not. """
+	if isinstance(value, str):
+		return value.decode('utf-8', 'replace')
+	return value
+
+def format_json(record):
+	""" One JSON object per line """
+	(time_stamp, event_name, mask, path, name, cookie, is_dir, message, source) = record
+	data = {
+		'time': time_stamp,
+		'event': event_name,
+		'mask': mask,
+		'path': _text(path),
+		'name': _text(name),
+		'cookie': cookie,
+		'dir': is_dir,
+	}
+	if source:
+		data['source'] = _text(source)
+	return json.dumps(data, separators=(',', ':')) + "\n"
+
+def _binary_string(value):
+	value = (_text(value) or u'').encode('utf-8')
+	return struct.pack('!H', len(value)) + value
+
+def format_binary(record):
+	""" Length prefixed records, all integers in network byte order:
+	record length (4 bytes), epoch time (double), mask (4 bytes),
+	cookie (4 bytes), is_dir (1 byte), then the event name, path, name
+	and source of a move, each as a 2 byte length followed by the UTF-8
+	bytes. """
+	(time_stamp, event_name, mask, path, name, cookie, is_dir, message, source) = record
+	data = struct.pack('!dIIB', time_stamp, mask, cookie, is_dir and 1 or 0) + \
+		_binary_string(event_name or '') + _binary_string(path or '') + \
+		_binary_string(name) + _binary_string(source)
+	return struct.pack('!I', len(data)) + data
+
+formats = {
+	'text': format_text,
+	'json': format_json,
+	'binary': format_binary,
+}
+
+class LogWriter(Thread):
+	""" Writes the records of all the watches logging to one file from a
+	thread of its own, keeping the file open. Records are formatted
+	and gathered, and written together once buffer_size bytes have
+	gathered or flush_interval seconds after the first of them,
+	whichever comes first. Errors are kept for the plugin to report.
+	
+	The file is rotated (renamed to path.1, path.1 to path.2 and so on,
+	keeping rotate_count old files) when it grows over rotate_size bytes
+	or is older than rotate_interval seconds, if these are set.
+	
+	reconfigure() changes the options; records written before are
+	written with the old ones. """
+	def __init__(self, path, buffer_size=65536, flush_interval=1, format='text',
+			rotate_size=0, rotate_interval=0, rotate_count=5):
+		Thread.__init__(self)
+		self.setDaemon(True)
+		self.path = path
+		# The watches writing to us -> the options each asked for
+		self.users = {}
+		self.options = {
+			'buffer_size': buffer_size,
+			'flush_interval': flush_interval,
+			'format': format,
+			'rotate_size': rotate_size,
+			'rotate_interval': rotate_interval,
+			'rotate_count': rotate_count,
+		}
+		self._configure(**self.options)
+		self._open()
+		self._queue = Queue()
+		self._errors = []
+		self.start()
+	
+	def _configure(self, buffer_size, flush_interval, format, rotate_size,
+			rotate_interval, rotate_count):
+		self._format = formats[format]
+		self._buffer_size = buffer_size
+		self._flush_interval = flush_interval
+		self._rotate_size = rotate_size
+		self._rotate_interval = rotate_interval
+		self._rotate_count = rotate_count
+	
+	def _open(self):
+		self._file = file(self.path, 'ab')
+		self._size = os.fstat(self._file.fileno()).st_size
+		self._opened = time()
+	
+	def _rotate(self):
+		self._file.close()
+		for number in range(self._rotate_count - 1, 0, -1):
+			older = "%s.%d" % (self.path, number)
+			if os.path.exists(older):
+				os.rename(older, "%s.%d" % (self.path, number + 1))
+		if self._rotate_count > 0:
+			os.rename(self.path, self.path + '.1')
+		else:
+			os.unlink(self.path)
+		self._open()
+	
+	def _rotation_due(self):
+		if self._rotate_size and self._size >= self._rotate_size:
+			return True
+		if self._rotate_interval and time() - self._opened >= self._rotate_interval:
+			return True
+		return False
+	
+	def write(self, record):
+		self._queue.put(record)
+	
+	def reconfigure(self, options):
+		self.options = dict(self.options, **options)
+		self._queue.put(self.options)
+	
+	def write_many(self, records):
+		""" Write a list of records, in one go """
+		self._queue.put(records)
+	
+	def flush(self):
+		""" Wait until everything written so far is in the file """
+		done = Event()
+		self._queue.put(done)
+		done.wait()
+	
+	def close(self):
+		""" Write out what is left and close the file """
+		self._queue.put(None)
+		self.join()
+	
+	def pop_errors(self):
+		errors = self._errors
+		self._errors = []
+		return errors
+	
+	def _next(self, deadline):
+		""" The next item of the queue, or False at the deadline """
+		try:
+			if deadline is None:
+				return self._queue.get()
+			return self._queue.get(True, max(0, deadline - time()))
+		except Empty:
+			return False
+	
+	def _write(self, lines):
+		if not lines:
+			return
+		try:
+			if self._rotation_due():
+				self._rotate()
+			data = ''.join(lines)
+			self._file.write(data)
+			self._file.flush()
+			self._size += len(data)
+		except (IOError, OSError), data:
+			self._errors.append(str(data))
+	
+	def run(self):
+		lines = []
+		size = 0
+		deadline = None
+		while True:
+			item = self._next(deadline)
+			if isinstance(item, (tuple, list)):
+				records = item
+				if isinstance(item, tuple):
+					records = [item]
+				for record in records:
+					try:
+						line = self._format(record)
+					except Exception, data:
+						# Lose the record, not the writer
+						self._errors.append("Could not format record: %s" % data)
+						continue
+					lines.append(line)
+					size += len(line)
+				if deadline is None:
+					deadline = time() + self._flush_interval
+				if size < self._buffer_size:
+					continue
+			self._write(lines)
+			lines = []
+			size = 0
+			deadline = None
+			if item is None:
+				break
+			elif isinstance(item, dict):
+				self._configure(**item)
+			elif item and not isinstance(item, (tuple, list)):
+				# Someone is waiting for a flush
+				item.set()
+		try:
+			self._file.close()
+		except IOError, data:
+			self._errors.append(str(data))
+
+class LogWriters(object):
+	""" The log writers of all watches, one per file. A writer is
+	closed when the last watch using it dies. """
+	def __init__(self):
+		self._writers = {}
+		self._lock = Lock()
+	
+	def get(self, path, watch, options):
+		""" Return the writer of path, creating it with options
+		(LogWriter keyword arguments) if there is none. A watch asking
+		for other options than before (its config was reloaded) has the
+		writer reconfigured; otherwise the first watch's options stay. """
+		self._lock.acquire()
+		try:
+			writer = self._writers.get(path)
+			if not writer:
+				writer = LogWriter(path, **options)
+				self._writers[path] = writer
+			elif writer.users.get(watch, options) != options and writer.options != options:
+				writer.reconfigure(options)
+			writer.users[watch] = options
+			return writer
+		finally:
+			self._lock.release()
+	
+	def release(self, watch):
+		""" The watch won't write any more: flush its writers and close
+		the ones nobody else uses. Return them to check for errors. """
+		self._lock.acquire()
+		try:
+			used = []
+			unused = []
+			for (path, writer) in self._writers.items():
+				if not watch in writer.users:
+					continue
+				del writer.users[watch]
+				if writer.users:
+					used.append(writer)
+				else:
+					unused.append(self._writers.pop(path))
+		finally:
+			self._lock.release()
+		for writer in used:
+			writer.flush()
+		for writer in unused:
+			writer.close()
+		return used + unused
+
+# Guards the creation of the LogWriters in the cache
+_writers_lock = Lock()
 
 class Scribe(iPlugin):
 	""" The logging plugin """
 	
+	outputs = ('scribe_log',)
+	
 	# Here is a dictionary of the messages we print.
 	_messages = {
 	# file|directory '<name>' was accessed.
@@ -21,57 +288,147 @@ class Scribe(iPlugin):
 	'IN_MOVE_SELF': "watched %s '%s' was itself MOVED",
 	'IN_MOVED_FROM': "%s '%s' just MOVED OUT",
 	'IN_MOVED_TO': "%s '%s' just MOVED IN",
+	# the watch paired the two halves (correlate_moves)
+	'IN_MOVE': "%s '%s' was MOVED to '%s'",
 	'IN_OPEN': "%s '%s' was OPENED",
 	'IN_foo': "",
 	'WATCH_INIT': "WATCH STARTED",
 	'WATCH_DEAD': "WATCH STOPPED",
 	}
 	
-	def _log(self, msg):
+	def _logged_events(self):
+		""" The events we were asked to log ('scribe_events'),
+		by default all of them. """
+		events = self._config.get('scribe_events', self._messages.keys())
+		if not isinstance(events, list):
+			events = [events]
+		if 'IN_MOVED_FROM' in events or 'IN_MOVED_TO' in events:
+			# A correlated move stands for both
+			events = events + ['IN_MOVE']
+		return events
+	
+	def get_mask(self):
+		mask = 0
+		for event_name in self._logged_events():
+			mask |= getattr(EventsCodes, event_name, 0)
+			if event_name == 'IN_MOVE':
+				mask |= EventsCodes.IN_MOVED_FROM | EventsCodes.IN_MOVED_TO
+		return mask
+	
+	def _writers(self):
+		""" The LogWriters shared by all watches """
+		_writers_lock.acquire()
+		try:
+			writers = self._cache.get('scribe_writers')
+			if not writers:
+				writers = LogWriters()
+				self._cache.push('scribe_writers', writers, True)
+			return writers
+		finally:
+			_writers_lock.release()
+	
+	def _check_writer(self, writer):
+		errors = writer.pop_errors()
+		if errors:
+			raise iPluginError("Could not write to log file '%s': %s" % (writer.path, "; ".join(errors)))
+	
+	def _format(self):
+		format = self._config.get('scribe_format', 'text')
+		if not formats.has_key(format):
+			raise iPluginError("Unknown scribe_format '%s'." % format)
+		return format
+	
+	def _writer_options(self):
+		""" The LogWriter options from our config """
+		return {
+			'buffer_size': int(self._config.get('scribe_buffer_size', 65536)),
+			'flush_interval': float(self._config.get('scribe_flush_interval', 1)),
+			'format': self._format(),
+			'rotate_size': int(self._config.get('scribe_rotate_size', 0)),
+			'rotate_interval': float(self._config.get('scribe_rotate_interval', 0)),
+			'rotate_count': int(self._config.get('scribe_rotate_count', 5)),
+		}
+	
+	def _record(self, msg, event=None):
+		if event:
+			mask = getattr(EventsCodes, event.event_name, 0)
+			source = ''
+			if event.event_name == 'IN_MOVE':
+				mask = EventsCodes.IN_MOVED_FROM | EventsCodes.IN_MOVED_TO
+				source = os.path.join(event.src_path, event.src_name)
+			record = (time(), event.event_name, mask, event.path,
+				getattr(event, 'name', None) or '', getattr(event, 'cookie', None) or 0,
+				bool(getattr(event, 'is_dir', False)), msg, source)
+		else:
+			record = (time(), None, 0, None, '', 0, False, msg, '')
+		return record
+	
+	def _write(self, records):
+		if not records:
+			return
 		if not self._config.has_key('scribe_log'):
 			raise iPluginError("Missing scribe_log directive.")
-			return
 		
 		if self._config['scribe_log'] != '-':
-			log_file = self._cache.pop('scribe_' + self._config['scribe_log'])
-			if not log_file:
-				try:
-					log_file = file(self._config['scribe_log'], 'a')
-					self._cache.push('scribe_' + self._config['scribe_log'], log_file, True)
-				except IOError, data:
-					raise iPluginError("Could not open log file '%s': %s" % (self._config['scribe_log'], data))
-			
 			try:
-				print >>log_file, "%s " % datetime.datetime.now() + msg
+				writer = self._writers().get(self._config['scribe_log'], self._watch, self._writer_options())
 			except IOError, data:
-				raise iPluginError("Could not write to log file '%s': %s" % (self._config['scribe_log'], data))
+				raise iPluginError("Could not open log file '%s': %s" % (self._config['scribe_log'], data))
+			self._check_writer(writer)
+			writer.write_many(records)
 		else:
 			# 'scribe_log = -' means write to stdout
-			print "%s " % datetime.datetime.now() + msg
+			sys.stdout.write(''.join([formats[self._format()](record) for record in records]))
+	
+	def _release(self):
+		""" Our watch is dead - flush our lines """
+		for writer in self._writers().release(self._watch):
+			self._check_writer(writer)
 	
 	def process_event(self, event):
-		watch = self._watch
+		self.process_events([event])
+	
+	def process_events(self, events):
+		""" Log a batch of events, handing their lines to the writer at once """
+		records = []
+		for event in events:
+			records.extend(self._records(event))
+		self._write(records)
+		for event in events:
+			if event.event_name == 'WATCH_DEAD':
+				self._release()
+	
+	def _records(self, event):
+		""" The records logging an event """
 		cache = self._cache
+		records = []
 		
 		try:
 		
 			message = self._messages[event.event_name]
 			
+			if not event.event_name.startswith('WATCH_') and not event.event_name in self._logged_events():
+				return records
+			
 			if event.event_name.startswith('WATCH_'):
-				self._log(("scribe: %s: " % event.path) + message)
-				return
+				records.append(self._record(("scribe: %s: " % event.path) + message, event))
+				return records
 			
 			name = event.name
 			if not name: name = '.'
 			
+			kind = 'file'
 			if event.is_dir:
-				message = message % ('directory', name)
+				kind = 'directory'
+			if event.event_name == 'IN_MOVE':
+				message = message % (kind, os.path.join(event.src_path, event.src_name), name)
 			else:
-				message = message % ('file', name)
+				message = message % (kind, name)
 			
-			self._log(("scribe: %s: " % event.path) + message)
-				
-			if event.event_name.startswith('IN_MOVED_'):
+			records.append(self._record(("scribe: %s: " % event.path) + message, event))
+			
+			# Structured records carry the cookie, their readers match moves
+			if event.event_name.startswith('IN_MOVED_') and self._format() == 'text':
 				# Try to find a match in the cache
 				cached_event = cache.pop('scribe_'+str(event.cookie))
 				if cached_event:
@@ -84,7 +441,7 @@ class Scribe(iPlugin):
 					if event.is_dir:
 						message = "scribe: MOVE events matched: directory '%s' was moved to '%s'"
 					
-					self._log(message % (os.path.join(moved_from.path, moved_from.name), os.path.join(moved_to.path, moved_to.name)))
+					records.append(self._record(message % (os.path.join(moved_from.path, moved_from.name), os.path.join(moved_to.path, moved_to.name))))
 				
 				else:
 					# Not found in cache - this is first hit
@@ -92,3 +449,4 @@ class Scribe(iPlugin):
 			
 		except KeyError:
 			pass
+		return records
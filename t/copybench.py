@@ -0,0 +1,71 @@
+#!/usr/bin/python
+""" Compare throughput and CPU time of the Replica copy strategies.
+
+Usage: copybench.py [size in MB] [directory]
+
+The directory should be on the filesystem you want to mirror to -
+reflink copies work only on copy-on-write filesystems (btrfs, xfs). """
+
+from iobserver.plugins import replica
+
+import shutil
+import tempfile
+import sys
+import os
+import os.path
+from time import time
+
+def cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+def bench(copy, source, destination, size):
+	""" Copy source to destination, return (MB/s, CPU seconds) """
+	if os.path.exists(destination):
+		os.unlink(destination)
+	start = time()
+	start_cpu = cpu_time()
+	copy(source, destination, size)
+	os.system('sync')
+	elapsed = time() - start
+	cpu = cpu_time() - start_cpu
+	return (size / elapsed / (1 << 20), cpu)
+
+def strategy_copy(function):
+	def copy(source, destination, size):
+		source_fd = os.open(source, os.O_RDONLY)
+		destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+		try:
+			function(source_fd, destination_fd, size)
+		finally:
+			os.close(destination_fd)
+			os.close(source_fd)
+	return copy
+
+if __name__ == "__main__":
+	size = 256
+	if len(sys.argv) > 1:
+		size = int(sys.argv[1])
+	directory = tempfile.mkdtemp(dir=(len(sys.argv) > 2 and sys.argv[2] or None))
+	try:
+		source = os.path.join(directory, 'source')
+		destination = os.path.join(directory, 'destination')
+		data = os.urandom(1 << 20)
+		output = open(source, 'wb')
+		for i in range(size):
+			output.write(data)
+		output.close()
+		size = size << 20
+
+		strategies = [(name, strategy_copy(function)) for (name, function) in replica.copy_strategies]
+		strategies.append(('copy2', lambda source, destination, size: shutil.copy2(source, destination)))
+
+		print "%-16s %10s %10s" % ('strategy', 'MB/s', 'CPU s')
+		for (name, copy) in strategies:
+			try:
+				(throughput, cpu) = bench(copy, source, destination, size)
+				print "%-16s %10.1f %10.3f" % (name, throughput, cpu)
+			except (IOError, OSError), data:
+				print "%-16s %21s" % (name, 'unsupported (%s)' % data.strerror)
+	finally:
+		shutil.rmtree(directory)
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+""" End to end benchmark: an iObserver with Scribe and Replica watching
+a temporary tree while typical workloads run against it.
+
+Usage: fsbench.py [options] [workload ...]
+
+Workloads: create, mkdirp, append, rename, untar (all by default).
+
+For each workload it reports the operations per second (up to the
+moment the mirror has caught up), the latency from an operation to the
+mirror reflecting it (percentiles, in milliseconds), the CPU time used
+and the peak memory of the process. With --json a JSON object per
+workload is printed instead, one per line, to compare runs.
+
+The workloads run in the same process as the observer, so the CPU
+time includes theirs. """
+
+from iobserver import *
+
+from optparse import OptionParser
+from threading import Lock
+from time import time, sleep
+
+import resource
+import tarfile
+import tempfile
+import shutil
+import json
+import sys
+import os
+import os.path
+
+def cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+def percentile(values, fraction):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Probe(iPlugin):
+	""" Comes after Replica in the dispatch table: when it sees an
+	event, the mirror has already been updated for it. Operations of
+	the workload are matched with the events by path. """
+
+	mask = EventsCodes.IN_ATTRIB | EventsCodes.IN_CREATE | EventsCodes.IN_DELETE | \
+		EventsCodes.IN_MODIFY | EventsCodes.IN_MOVED_FROM | EventsCodes.IN_MOVED_TO
+
+	def __init__(self):
+		iPlugin.__init__(self, None, None, {})
+		self._lock = Lock()
+		self._pending = {}
+		self.latencies = []
+
+	def expect(self, path):
+		""" An operation on path was just done """
+		now = time()
+		self._lock.acquire()
+		try:
+			self._pending.setdefault(path, []).append(now)
+		finally:
+			self._lock.release()
+
+	def waiting(self):
+		return len(self._pending)
+
+	def reset(self):
+		self._pending = {}
+		self.latencies = []
+
+	def process_event(self, event):
+		if not getattr(event, 'name', None):
+			return
+		now = time()
+		path = os.path.join(event.path, event.name)
+		self._lock.acquire()
+		try:
+			for done in self._pending.pop(path, []):
+				self.latencies.append(now - done)
+		finally:
+			self._lock.release()
+
+class Workloads(object):
+	""" Each workload works in self.source and tells the probe about
+	every object it touches. Returns the number of operations done. """
+	def __init__(self, source, probe, options):
+		self.source = source
+		self.probe = probe
+		self.options = options
+
+	def _path(self, *names):
+		return os.path.join(self.source, *names)
+
+	def create(self):
+		""" Many small files in one directory """
+		for i in range(self.options.files):
+			path = self._path('file%06d' % i)
+			open(path, 'w').write('x' * 100)
+			self.probe.expect(path)
+		return self.options.files
+
+	def mkdirp(self):
+		""" Deep trees made at once, each with a file at the bottom """
+		operations = 0
+		for tree in range(self.options.trees):
+			names = ['tree%d' % tree] + ['level%d' % level for level in range(self.options.depth)]
+			os.makedirs(self._path(*names))
+			path = self._path(*(names + ['leaf']))
+			open(path, 'w').write('leaf')
+			self.probe.expect(path)
+			operations += self.options.depth + 1
+		return operations
+
+	def append(self):
+		""" Large appends to a few files """
+		chunk = os.urandom(1 << 20)
+		operations = 0
+		for i in range(self.options.append_files):
+			path = self._path('log%d' % i)
+			output = open(path, 'ab')
+			for j in range(self.options.append_mb):
+				output.write(chunk)
+				output.flush()
+				self.probe.expect(path)
+				operations += 1
+			output.close()
+		return operations
+
+	def rename(self):
+		""" Renaming storm over existing files (not timed: their creation) """
+		for i in range(self.options.files):
+			path = self._path('old%06d' % i)
+			open(path, 'w').write('x')
+			self.probe.expect(path)
+		# Renamed before being mirrored, they would be copied instead
+		self.settle()
+		self.probe.reset()
+		for i in range(self.options.files):
+			destination = self._path('new%06d' % i)
+			os.rename(self._path('old%06d' % i), destination)
+			self.probe.expect(destination)
+		return self.options.files
+
+	def untar(self):
+		""" Extracting a big archive, prepared in advance """
+		archive = os.path.join(os.path.dirname(self.source), 'archive.tar')
+		if not os.path.exists(archive):
+			staging = tempfile.mkdtemp(dir=os.path.dirname(self.source))
+			for i in range(self.options.files):
+				directory = os.path.join(staging, 'dir%03d' % (i % 100))
+				if not os.path.isdir(directory):
+					os.mkdir(directory)
+				open(os.path.join(directory, 'file%06d' % i), 'w').write('y' * 1000)
+			output = tarfile.open(archive, 'w')
+			output.add(staging, 'archive')
+			output.close()
+			shutil.rmtree(staging)
+		archive = tarfile.open(archive)
+		members = archive.getmembers()
+		# The events come while extracting
+		for member in members:
+			self.probe.expect(self._path(member.name))
+		archive.extractall(self.source)
+		return len(members)
+
+	def settle(self, timeout=60):
+		""" Wait until the mirror has caught up with what we did """
+		deadline = time() + timeout
+		while self.probe.waiting() and time() < deadline:
+			sleep(0.01)
+		return not self.probe.waiting()
+
+def run(name, options):
+	root = tempfile.mkdtemp(dir=options.directory)
+	source = os.path.join(root, 'source')
+	os.mkdir(source)
+	probe = Probe()
+	observer = iObserver({
+		'global': {'shared_notifier': options.shared_notifier},
+		'watches': {
+			source: {
+				'plugins': ['scribe', 'replica', 'probe'],
+				'scribe_log': os.path.join(root, 'scribe.log'),
+				'scribe_format': options.scribe_format,
+				'replica_destination': os.path.join(root, 'mirror'),
+				'correlate_moves': 'yes',
+			},
+		},
+	})
+	observer._plugins['probe'] = probe
+	try:
+		observer.start()
+		while not [done for (directories, done) in observer.registration_progress().values() if done]:
+			if not observer.is_alive() or observer.error():
+				raise SystemExit("Observer failed: %s" % observer.error())
+			sleep(0.01)
+		workloads = Workloads(source, probe, options)
+
+		start = time()
+		start_cpu = cpu_time()
+		operations = getattr(workloads, name)()
+		caught_up = workloads.settle()
+		elapsed = time() - start
+		cpu = cpu_time() - start_cpu
+
+		latencies = [latency * 1000 for latency in probe.latencies]
+		return {
+			'workload': name,
+			'operations': operations,
+			'seconds': elapsed,
+			'operations_per_second': operations / elapsed,
+			'caught_up': caught_up,
+			'latency_ms': {
+				'p50': percentile(latencies, 0.5),
+				'p90': percentile(latencies, 0.9),
+				'p99': percentile(latencies, 0.99),
+				'max': latencies and max(latencies) or None,
+			},
+			'cpu_seconds': cpu,
+			'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			'error': observer.error(),
+		}
+	finally:
+		observer.stop()
+		observer.wait(10)
+		shutil.rmtree(root)
+
+if __name__ == "__main__":
+	parser = OptionParser(usage="%prog [options] [workload ...]")
+	parser.add_option('--files', type='int', default=10000, help="files for create, rename and untar")
+	parser.add_option('--trees', type='int', default=100, help="trees for mkdirp")
+	parser.add_option('--depth', type='int', default=20, help="depth of the mkdirp trees")
+	parser.add_option('--append-files', type='int', default=4, help="files for append")
+	parser.add_option('--append-mb', type='int', default=64, help="megabytes appended to each file")
+	parser.add_option('--scribe-format', default='text', help="scribe_format of the log")
+	parser.add_option('--shared-notifier', action='store_true', default=False)
+	parser.add_option('--directory', default=None, help="where to make the temporary trees")
+	parser.add_option('--json', action='store_true', default=False, help="print a JSON object per workload")
+	(options, names) = parser.parse_args()
+	names = names or ['create', 'mkdirp', 'append', 'rename', 'untar']
+
+	if not options.json:
+		print "%-8s %8s %10s %8s %8s %8s %8s %8s %10s" % \
+			('workload', 'ops', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'CPU s', 'RSS KB')
+	for name in names:
+		result = run(name, options)
+		if options.json:
+			print json.dumps(result)
+		else:
+			latency = result['latency_ms']
+			print "%-8s %8d %10.1f %8s %8s %8s %8s %8.2f %10d" % (
+				name, result['operations'], result['operations_per_second'],
+				latency['p50'] is not None and "%.1f" % latency['p50'] or '-',
+				latency['p90'] is not None and "%.1f" % latency['p90'] or '-',
+				latency['p99'] is not None and "%.1f" % latency['p99'] or '-',
+				latency['max'] is not None and "%.1f" % latency['max'] or '-',
+				result['cpu_seconds'], result['max_rss_kb'])
+		if not result['caught_up'] or result['error']:
+			print >>sys.stderr, "%s: mirror did not catch up (%s)" % (name, result['error'])
+		sys.stdout.flush()
@@ -1,12 +1,20 @@
 import unittest
 
-from time import sleep
+from time import time, sleep
+from threading import currentThread
 
 from iobserver import *
-from iobserver.plugins import scribe, mirror
+from iobserver.plugins import scribe, replica
+import replay
 
 import os
 import os.path
+import struct
+import json
+import socket
+import pstats
+import sys
+from StringIO import StringIO
 
 class iObserverTest(unittest.TestCase):
 	def testConfig(self):
@@ -28,24 +36,24 @@ class iObserverTest(unittest.TestCase):
 		cache = iCache(0, 10)
 		for i in range(1, 6):
 			cache.push(i, i)
-		self.assertTrue(len(cache._cache) == 5)
+		self.assertTrue(len(cache) == 5)
 		for i in range(1, 6):
 			cache.push(i+10, i, True)
-		self.assertTrue(len(cache._cache) == 10)
+		self.assertTrue(len(cache) == 10)
 		cache.push('boo', 1) # This should cause the expire to kick in
-		self.assertTrue(len(cache._cache) == 6)
+		self.assertTrue(len(cache) == 6)
 		
 	def testCacheNoExpire(self):
 		""" Test the iCache "persistent" option """
 		cache = iCache(3, 10)
 		for i in range(1, 6):
 			cache.push(i, i)
-		self.assertTrue(len(cache._cache) == 5)
+		self.assertTrue(len(cache) == 5)
 		for i in range(1, 6):
 			cache.push(i+10, i, True)
-		self.assertTrue(len(cache._cache) == 10)
+		self.assertTrue(len(cache) == 10)
 		cache.push('boo', 1) # This should cause the expire to kick in
-		self.assertTrue(len(cache._cache) == 11)
+		self.assertTrue(len(cache) == 11)
 		
 	def testCache(self):
 		""" General ppush/pop test """
@@ -56,11 +64,63 @@ class iObserverTest(unittest.TestCase):
 		value = cache.pop(key)
 		self.assertTrue(value == 666)
 		
+	def testCacheBounds(self):
+		""" Least recently used entries are evicted, persistent ones kept """
+		cache = iCache(60, 100, max_entries=4, shards=1)
+		cache.push('kept', 1, True)
+		for i in range(4):
+			cache.push(i, i)
+		cache.get(0)
+		cache.push(4, 4)
+		self.assertTrue(cache.get(1) is None)
+		self.assertTrue(cache.get(0) == 0 and cache.get('kept') == 1)
+		stats = cache.get_stats()
+		self.assertTrue(stats['entries'] == 5 and stats['evictions'] == 1)
+		self.assertTrue(stats['hits'] == 3 and stats['misses'] == 1)
+		
+		# A reload applies a changed bound, not only a switch on or off
+		io = iObserver({'global': {'cache_max_entries': '100'}, 'watches': {}})
+		reloaded = {'global': dict(io._config['global']), 'watches': {}}
+		reloaded['global']['cache_max_entries'] = '200'
+		io._configure = lambda path: setattr(io, '_config', reloaded)
+		io._watches = {}
+		io._update_config()
+		self.assertTrue(io._cache._shards[0]._max_entries == io._cache._shard_bound(200, len(io._cache._shards)))
+		
+	def testCacheRegions(self):
+		""" Plugin regions are separate and go away with their watch """
+		cache = iCache(60, 100)
+		first = cache.region('watch', 'Replica')
+		first.push('move', 1)
+		first.push('pool', 2, True)
+		cache.region('watch', 'Scribe').push('move', 3)
+		cache.region('other', 'Replica').push('move', 4)
+		self.assertTrue(cache.region('watch', 'Replica') is first)
+		self.assertTrue(first.get('move') == 1 and len(cache) == 4)
+		cache.drop_regions('watch')
+		self.assertTrue(len(cache) == 1)
+		self.assertTrue(cache.region('other', 'Replica').get('move') == 4)
+		
+		# Also when a watch is never started or fails to register
+		io = iObserver()
+		for run in [False, True]:
+			watch = iWatch(io, {'scribe': scribe}, {'/a/b/c': {'plugins': 'scribe'}})
+			self.assertTrue(watch in io._cache._regions)
+			if run:
+				watch._register = lambda: 1 / 0
+				watch.run()
+			else:
+				watch.stop()
+			self.assertFalse(watch in io._cache._regions)
+		
 	def testWatchBad(self):
 		""" Here we have a bad watch config """
 		io = iObserver()
 		watch = iWatch(io, {}, {'/a/b/c': {'pluginss': ""}})
 		self.assertTrue(io.error())
+		io = iObserver()
+		watch = iWatch(io, {'empty': ModuleType('empty')}, {'/a/b/c': {'plugins': "empty"}})
+		self.assertTrue(io.error() and watch._dispatch == [])
 	
 	def testWatchGood(self):
 		""" Here we have a good config """
@@ -78,6 +138,628 @@ class iObserverTest(unittest.TestCase):
 		sleep(1)
 		self.assertTrue(io.error() == "TEST")
 	
+	def testWatchMask(self):
+		""" Watch subscribes only to what its plugins want """
+		io = iObserver()
+		watch = iWatch(io, {'replica': replica}, {'/a/b/c': {'plugins': 'replica', 'replica_destination': '/d'}})
+		self.assertFalse(watch._mask & EventsCodes.IN_ACCESS)
+		self.assertTrue(watch._mask & EventsCodes.IN_MODIFY)
+		watch = iWatch(io, {'scribe': scribe}, {'/a/b/c': {'plugins': 'scribe', 'scribe_log': '-', 'scribe_events': 'IN_OPEN'}})
+		self.assertTrue(watch._mask & EventsCodes.IN_OPEN)
+		self.assertFalse(watch._mask & EventsCodes.IN_ACCESS)
+	
+	def testWatchDispatch(self):
+		""" Dispatch table is rebuilt only on actual changes """
+		io = iObserver()
+		config = {'/a/b/c': {'plugins': ['replica', 'replica'], 'replica_destination': '/d'}}
+		watch = iWatch(io, {'replica': replica}, config)
+		self.assertTrue(len(watch._dispatch) == 1)
+		plugin = watch._dispatch[0][1]
+		watch.update_config({'replica': replica}, config)
+		self.assertFalse(watch._reconfigure())
+		self.assertTrue(watch._dispatch[0][1] is plugin)
+		config['/a/b/c']['replica_destination'] = '/e'
+		watch.update_config({'replica': replica}, config)
+		self.assertTrue(watch._reconfigure())
+		self.assertTrue(watch._dispatch[0][1]._config['replica_destination'] == '/e')
+	
+	def testCoalescer(self):
+		""" Repeated modifications merge, create+delete vanishes """
+		def event(event_name, name):
+			return pyinotify_Event({'event_name': event_name, 'path': '/x', 'name': name})
+		coalescer = iCoalescer(1, 10)
+		coalescer.push(event('IN_CREATE', 'a'), 0)
+		coalescer.push(event('IN_MODIFY', 'a'), 0)
+		coalescer.push(event('IN_DELETE', 'a'), 0)
+		coalescer.push(event('IN_MODIFY', 'b'), 0)
+		coalescer.push(event('IN_MODIFY', 'b'), 0.5)
+		self.assertFalse(coalescer.pop_due(1))
+		events = coalescer.pop_due(2)
+		self.assertTrue([(e.event_name, e.name) for e in events] == [('IN_MODIFY', 'b')])
+		self.assertTrue(coalescer.next_due(2) is None)
+	
+	def testReplicaDelta(self):
+		""" Delta copy writes only the changed blocks """
+		io = iObserver()
+		watch = iWatch(io, {'replica': replica}, {'./test': {'plugins': 'replica', 'replica_destination': 'mirrored', 'replica_mode': 'delta', 'replica_block_size': '1024'}})
+		plugin = watch._dispatch[0][1]
+		open('delta_source', 'wb').write('a' * 4096 + 'b' * 1024 + 'c' * 100)
+		open('delta_target', 'wb').write('a' * 4096 + 'x' * 2048)
+		plugin._copy_file('delta_source', 'delta_target')
+		self.assertTrue(open('delta_target', 'rb').read() == open('delta_source', 'rb').read())
+		self.assertTrue(plugin.get_stats()['delta_written'] == 1124)
+		self.assertTrue(plugin.get_stats()['delta_saved'] == 4096)
+		os.unlink('delta_source')
+		os.unlink('delta_target')
+	
+	def testCopyPool(self):
+		""" Same path operations keep their order, others don't wait """
+		pool = replica.CopyPool(4)
+		done = []
+		def task(n):
+			sleep(0.01 * (5 - n))
+			done.append(n)
+		for n in range(5):
+			pool.submit(['/m/a'], task, n)
+		pool.submit(['/m/a/b'], done.append, 'a/b')
+		pool.submit(['/m/c'], done.append, 'c')
+		pool.stop()
+		self.assertTrue(done.index('c') < 4)
+		self.assertTrue(done[-1] == 'a/b')
+		self.assertTrue([n for n in done if isinstance(n, int)] == range(5))
+		
+		pool = replica.CopyPool(1)
+		self.assertTrue(pool._conflict(['/m/a'], set(['/m/a/b']), set(['/m/a', '/m', '/'])))
+		self.assertTrue(pool._conflict(['/m/a/b'], set(['/m/a']), set(['/m', '/'])))
+		self.assertTrue(not pool._conflict(['/m/ab'], set(['/m/a']), set(['/m', '/'])))
+		pool.stop()
+	
+	def testReplicaSync(self):
+		""" Incremental sync copies and deletes only what differs """
+		os.system("rm -rf sync_source sync_mirror; mkdir -p sync_source/dir sync_mirror/dir sync_mirror/extra")
+		open('sync_source/same', 'w').write('same')
+		open('sync_source/dir/new', 'w').write('new')
+		os.system("cp -p sync_source/same sync_mirror/same; ln -s .. sync_source/dir/loop")
+		io = iObserver()
+		watch = iWatch(io, {'replica': replica}, {'sync_source': {'plugins': 'replica', 'replica_destination': 'sync_mirror', 'replica_init': 'sync'}})
+		plugin = watch._dispatch[0][1]
+		plugin._init_mirror(None)
+		stats = plugin.get_stats()
+		self.assertTrue(stats['sync_copied'] == 1)
+		self.assertTrue(stats['sync_deleted'] == 1)
+		self.assertTrue(open('sync_mirror/dir/new').read() == 'new')
+		self.assertFalse(os.path.exists('sync_mirror/extra'))
+		self.assertFalse(os.path.lexists('sync_mirror/dir/loop'))
+		os.system("rm -rf sync_source sync_mirror")
+	
+	def testReplicaManifest(self):
+		""" Restart compares the source with the manifest only """
+		os.system("rm -rf sync_source sync_mirror sync.db; mkdir -p sync_source/dir")
+		open('sync_source/same', 'w').write('same')
+		open('sync_source/dir/changed', 'w').write('old')
+		config = {'sync_source': {'plugins': 'replica', 'replica_destination': 'sync_mirror', 'replica_init': 'sync', 'replica_manifest': 'sync.db'}}
+		io = iObserver()
+		watch = iWatch(io, {'replica': replica}, config)
+		plugin = watch._dispatch[0][1]
+		plugin._init_mirror(None)
+		self.assertTrue(open('sync_mirror/dir/changed').read() == 'old')
+		
+		# While we are down...
+		open('sync_source/dir/changed', 'w').write('new!')
+		os.unlink('sync_source/same')
+		open('sync_source/added', 'w').write('added')
+		
+		plugin._init_mirror(None)
+		stats = plugin.get_stats()
+		self.assertTrue(stats['sync_copied'] == 2)
+		self.assertTrue(stats['sync_deleted'] == 1)
+		self.assertTrue(open('sync_mirror/dir/changed').read() == 'new!')
+		self.assertFalse(os.path.exists('sync_mirror/same'))
+		self.assertTrue('added' in plugin._get_manifest().entries())
+		plugin._close_manifest()
+		os.system("rm -rf sync_source sync_mirror sync.db*")
+	
+	def testReplicaFilter(self):
+		""" What the watch excludes is neither mirrored nor recorded """
+		for init in ('copy', 'sync', 'manifest'):
+			os.system("rm -rf sync_source sync_mirror sync.db*; mkdir -p sync_source/.git sync_source/dir sync_mirror/.git")
+			open('sync_source/.git/HEAD', 'w').write('ref')
+			open('sync_source/dir/kept', 'w').write('kept')
+			open('sync_source/dir/kept~', 'w').write('backup')
+			open('sync_mirror/.git/HEAD', 'w').write('stale')
+			config = {'plugins': 'replica', 'replica_destination': 'sync_mirror', 'replica_init': init, 'exclude': ['.git', '*~']}
+			if init == 'manifest':
+				config.update({'replica_init': 'sync', 'replica_manifest': 'sync.db'})
+			io = iObserver()
+			watch = iWatch(io, {'replica': replica}, {'sync_source': config})
+			plugin = watch._dispatch[0][1]
+			plugin._init_mirror(None)
+			# Once more, now that the manifest (if any) is there
+			plugin._init_mirror(None)
+			self.assertTrue(open('sync_mirror/dir/kept').read() == 'kept')
+			self.assertFalse(os.path.exists('sync_mirror/.git'))
+			self.assertFalse(os.path.exists('sync_mirror/dir/kept~'))
+			if init == 'manifest':
+				entries = plugin._get_manifest().entries()
+				self.assertTrue('dir/kept' in entries)
+				self.assertFalse('.git' in entries or 'dir/kept~' in entries)
+				plugin._close_manifest()
+		os.system("rm -rf sync_source sync_mirror sync.db*")
+	
+	def testReplicaCopyStrategies(self):
+		""" Every copy strategy either works or falls back """
+		io = iObserver()
+		open('copy_source', 'wb').write(os.urandom(300000))
+		for strategy in ['auto', 'reflink', 'copy_file_range', 'sendfile', 'buffer', 'copy2']:
+			watch = iWatch(io, {'replica': replica}, {strategy: {'plugins': 'replica', 'replica_destination': 'mirrored', 'replica_copy': strategy}})
+			plugin = watch._dispatch[0][1]
+			plugin._full_copy('copy_source', 'copy_target')
+			self.assertTrue(open('copy_target', 'rb').read() == open('copy_source', 'rb').read())
+			if strategy != 'copy2':
+				self.assertTrue(plugin.get_stats()['copy_strategy'])
+			os.unlink('copy_target')
+		
+		# A kernel copy stopping short is finished through a buffer
+		source_fd = os.open('copy_source', os.O_RDONLY)
+		destination_fd = os.open('copy_target', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+		replica._copy_loop(lambda count: 0, 300000, source_fd, destination_fd)
+		os.close(destination_fd)
+		os.close(source_fd)
+		self.assertTrue(open('copy_target', 'rb').read() == open('copy_source', 'rb').read())
+		os.unlink('copy_target')
+		
+		watch = iWatch(io, {'replica': replica}, {'bad': {'plugins': 'replica', 'replica_destination': 'mirrored', 'replica_copy': 'fast'}})
+		self.assertRaises(iPluginError, watch._dispatch[0][1]._full_copy, 'copy_source', 'copy_target')
+		os.unlink('copy_source')
+	
+	def testEngineRoute(self):
+		""" Shared engine routes events to the watches they belong to """
+		io = iObserver({'global': {'shared_notifier': True}, 'watches': {}})
+		outer = iWatch(io, {'replica': replica}, {'/a': {'plugins': 'replica', 'replica_destination': '/d'}})
+		inner = iWatch(io, {'scribe': scribe}, {'/a/b': {'plugins': 'scribe', 'scribe_log': '-', 'scribe_events': 'IN_OPEN'}})
+		engine = iNotifierEngine.__new__(iNotifierEngine)
+		engine._owners = {'/a': [outer], '/a/b': [inner]}
+		engine._roots = {outer: 1, inner: 2}
+		engine.route(pyinotify_Event({'event_name': 'IN_OPEN', 'path': '/a/b/c', 'name': 'd'}))
+		engine.route(pyinotify_Event({'event_name': 'IN_MODIFY', 'path': '/a/b', 'name': 'e'}))
+		engine.route(pyinotify_Event({'event_name': 'IN_MODIFY', 'path': '/ab', 'name': 'f'}))
+		self.assertTrue([outer._queue.get_nowait().name] == ['e'] and outer._queue.empty())
+		self.assertTrue([inner._queue.get_nowait().name] == ['d'] and inner._queue.empty())
+		io._engine.stop()
+		
+		# The engine's own thread closes the notifier, after the last watch
+		class Notifier(object):
+			closed_by = None
+			def check_events(self, timeout):
+				sleep(0.01)
+				return False
+			def stop(self):
+				Notifier.closed_by = currentThread()
+		engine = iNotifierEngine(io)
+		engine._notifier = Notifier()
+		engine.start()
+		engine._roots = {outer: None}
+		engine._idle_event.clear()
+		engine.stop()
+		sleep(0.1)
+		self.assertTrue(Notifier.closed_by is None)
+		engine.remove_watch(outer)
+		self.assertTrue(Notifier.closed_by is engine._thread and not engine._thread.isAlive())
+	
+	def testAsynchronousPlugin(self):
+		""" Asynchronous plugins get their events in order, off the watch thread """
+		seen = []
+		class Slow(iPlugin):
+			asynchronous = True
+			def process_event(self, event):
+				sleep(0.01)
+				seen.append(event.event_name)
+		io = iObserver()
+		watch = iWatch(io, {'slow': Slow(None, None, {})}, {'/a/b/c': {'plugins': 'slow'}})
+		# Not running before the watch does
+		self.assertFalse(watch._dispatch[0][1]._thread.isAlive())
+		watch._start_workers()
+		for name in ['WATCH_INIT', 'IN_CREATE', 'IN_MODIFY']:
+			watch.process_event(pyinotify_Event({'event_name': name, 'path': '/a/b/c', 'name': 'x'}))
+		self.assertTrue(len(seen) < 3)
+		watch._stop_workers()
+		self.assertTrue(seen == ['WATCH_INIT', 'IN_CREATE', 'IN_MODIFY'])
+	
+	def testTreeWalker(self):
+		""" Parallel walk finds every directory, in batches """
+		os.system("rm -rf walk_tree; mkdir -p walk_tree/a/b/c walk_tree/d/e walk_tree/f; touch walk_tree/a/file")
+		batches = list(iTreeWalker('walk_tree', 3).batches(2))
+		found = []
+		for batch in batches:
+			self.assertTrue(len(batch) >= 1)
+			found.extend(batch)
+		self.assertTrue(sorted(found) == ['walk_tree/a', 'walk_tree/a/b', 'walk_tree/a/b/c', 'walk_tree/d', 'walk_tree/d/e', 'walk_tree/f'])
+		os.system("rm -rf walk_tree")
+	
+	def testScanNewDirectory(self):
+		""" Contents of a new tree are reported as created, once """
+		seen = []
+		class Recorder(iPlugin):
+			def process_event(self, event):
+				seen.append(os.path.join(event.path, event.name))
+		os.system("rm -rf scan_tree; mkdir -p scan_tree/new/a/b; touch scan_tree/new/a/b/file")
+		io = iObserver()
+		watch = iWatch(io, {'recorder': Recorder(None, None, {})}, {'scan_tree': {'plugins': 'recorder'}})
+		added = []
+		watch._add_watches = lambda paths, rec: added.extend(paths)
+		watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': 'scan_tree', 'name': 'new', 'is_dir': True}))
+		watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': 'scan_tree/new', 'name': 'a', 'is_dir': True}))
+		self.assertTrue(seen == ['scan_tree/new', 'scan_tree/new/a', 'scan_tree/new/a/b', 'scan_tree/new/a/b/file'])
+		self.assertTrue(added == ['scan_tree/new/a', 'scan_tree/new/a/b'])
+		
+		# Deleted and created again: that creation is new
+		del seen[:]
+		for name in ['IN_DELETE', 'IN_CREATE']:
+			watch.process_event(pyinotify_Event({'event_name': name, 'path': 'scan_tree/new/a/b', 'name': 'file', 'is_dir': False}))
+		self.assertTrue(seen == ['scan_tree/new/a/b/file'] * 2)
+		# And so is one that comes long after the scan
+		watch._synthesized_order = type(watch._synthesized_order)([(time_stamp - 10, created) for (time_stamp, created) in watch._synthesized_order])
+		for created in watch._synthesized.keys():
+			watch._synthesized[created] -= 10
+		watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': 'scan_tree/new/a', 'name': 'b', 'is_dir': False}))
+		self.assertTrue(seen[-1] == 'scan_tree/new/a/b')
+		os.system("rm -rf scan_tree")
+		
+		# The watch's own loop processes events holding the register lock
+		class Manager(object):
+			def add_watch(self, paths, mask, rec, auto_add):
+				return dict([(path, 1) for path in paths])
+		watch = iWatch(io, {'recorder': Recorder(None, None, {})}, {'scan_tree': {'plugins': 'recorder'}})
+		watch._watch_manager = Manager()
+		watch._watches = {}
+		watch._register_lock.acquire()
+		try:
+			self.assertTrue(watch._add_watches(['scan_tree/new'], rec=False) == {'scan_tree/new': 1})
+		finally:
+			watch._register_lock.release()
+	
+	def testOverflowRescan(self):
+		""" After an overflow only the differences are reported """
+		seen = []
+		class Recorder(iPlugin):
+			def process_event(self, event):
+				seen.append((event.event_name, os.path.join(event.path, event.name)))
+		os.system("rm -rf rescan_tree; mkdir -p rescan_tree/gone/sub rescan_tree/kept; echo a > rescan_tree/kept/file")
+		io = iObserver()
+		watch = iWatch(io, {'recorder': Recorder(None, None, {})}, {'rescan_tree': {'plugins': 'recorder', 'overflow_rescan': 'yes'}})
+		watch._take_snapshot()
+		added = []
+		watch._add_watches = lambda paths, rec: added.extend(paths)
+		os.system("rm -rf rescan_tree/gone; mkdir rescan_tree/new; echo abc > rescan_tree/kept/file")
+		watch.process_event(pyinotify_Event({'event_name': 'IN_Q_OVERFLOW', 'path': None, 'name': '', 'is_dir': False}))
+		self.assertTrue(watch.get_overflows() == 1)
+		watch._rescan()
+		self.assertTrue(seen == [('IN_DELETE', 'rescan_tree/gone'), ('IN_CREATE', 'rescan_tree/new'), ('IN_MODIFY', 'rescan_tree/kept/file')])
+		self.assertTrue(added == ['rescan_tree/new'])
+		del seen[:]
+		watch._rescan()
+		self.assertTrue(seen == [])
+		os.system("chmod 700 rescan_tree/kept")
+		watch._rescan()
+		self.assertTrue(seen == [('IN_ATTRIB', 'rescan_tree/kept')])
+		os.system("rm -rf rescan_tree")
+	
+	def testScribeWriter(self):
+		""" Log lines are written in batches and flushed on WATCH_DEAD """
+		if os.path.exists('batched.log'):
+			os.unlink('batched.log')
+		io = iObserver()
+		config = {'plugins': 'scribe', 'scribe_log': 'batched.log', 'scribe_flush_interval': '60'}
+		first = iWatch(io, {'scribe': scribe}, {'/a': config})
+		second = iWatch(io, {'scribe': scribe}, {'/b': config})
+		for watch in (first, second):
+			watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': watch.get_path(), 'name': 'x', 'is_dir': False}))
+		self.assertTrue(open('batched.log').read() == '')
+		first.process_event(pyinotify_Event({'event_name': 'WATCH_DEAD', 'path': '/a'}))
+		self.assertTrue(len(open('batched.log').readlines()) == 3)
+		second.process_event(pyinotify_Event({'event_name': 'WATCH_DEAD', 'path': '/b'}))
+		self.assertTrue(len(open('batched.log').readlines()) == 4)
+		
+		# A full buffer is written out and the writer keeps going
+		writer = scribe.LogWriter('batched.log', 1, 60)
+		writer.write((0, None, 0, None, '', 0, False, 'full', ''))
+		writer.flush()
+		self.assertTrue(writer.isAlive())
+		writer.close()
+		self.assertTrue(len(open('batched.log').readlines()) == 5)
+		os.unlink('batched.log')
+	
+	def testScribeFormats(self):
+		""" Structured records and rotation by size """
+		os.system("rm -f rotated.log*")
+		writer = scribe.LogWriter('rotated.log', buffer_size=0, format='json', rotate_size=50, rotate_count=2)
+		for i in range(4):
+			writer.write((1.5, 'IN_CREATE', 256, '/a', 'file%d' % i, 0, False, 'ignored', ''))
+			writer.flush()
+		writer.close()
+		self.assertTrue(os.path.exists('rotated.log.2') and not os.path.exists('rotated.log.3'))
+		record = json.loads(open('rotated.log').read())
+		self.assertTrue(record['name'] == 'file3' and record['mask'] == 256 and record['time'] == 1.5)
+		data = scribe.format_binary((1.5, 'IN_DELETE', 512, '/a', 'b', 7, True, '', ''))
+		self.assertTrue(len(data) == struct.unpack('!I', data[:4])[0] + 4)
+		self.assertTrue(struct.unpack('!dIIB', data[4:21]) == (1.5, 512, 7, 1))
+		
+		# Names that are not UTF-8, records without an event, bad records
+		odd = (1.5, 'IN_CREATE', 256, '/a', 'caf\xe9', 0, False, '', '')
+		self.assertTrue(json.loads(scribe.format_json(odd))['name'] == u'caf\ufffd')
+		self.assertTrue(scribe.format_binary(odd).endswith('caf\xef\xbf\xbd\x00\x00'))
+		scribe.format_binary((1.5, None, 0, None, '', 0, False, 'message', ''))
+		os.system("rm -f rotated.log*")
+		writer = scribe.LogWriter('rotated.log', buffer_size=0, format='json')
+		writer.write((1.5, 'IN_CREATE', 256, '/a', object(), 0, False, '', ''))
+		writer.write(odd)
+		writer.flush()
+		writer.close()
+		self.assertTrue(len(writer.pop_errors()) == 1)
+		self.assertTrue(len(open('rotated.log').readlines()) == 1)
+		os.system("rm -f rotated.log*")
+		
+		# A reload changing the format is obeyed
+		io = iObserver()
+		config = {'plugins': 'scribe', 'scribe_log': 'rotated.log', 'scribe_events': 'IN_CREATE'}
+		watch = iWatch(io, {'scribe': scribe}, {'/a': config})
+		event = pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a', 'name': 'x', 'is_dir': False})
+		watch.process_event(event)
+		watch.update_config({'scribe': scribe}, {'/a': dict(config, scribe_format='json')})
+		watch._reconfigure()
+		watch.process_event(event)
+		watch.process_event(pyinotify_Event({'event_name': 'WATCH_DEAD', 'path': '/a'}))
+		lines = open('rotated.log').readlines()
+		self.assertTrue('CREATED' in lines[0] and json.loads(lines[1])['name'] == 'x')
+		os.system("rm -f rotated.log*")
+	
+	def testMoveCorrelation(self):
+		""" Moves are paired by cookie, lone halves become delete/create """
+		seen = []
+		class Recorder(iPlugin):
+			def process_event(self, event):
+				seen.append((event.event_name, getattr(event, 'src_name', None), event.name))
+		io = iObserver()
+		watch = iWatch(io, {'recorder': Recorder(None, None, {})}, {'/a': {'plugins': 'recorder', 'correlate_moves': 'yes'}})
+		for (event_name, name, cookie) in [('IN_MOVED_FROM', 'a', 1), ('IN_MOVED_FROM', 'b', 2), ('IN_MOVED_TO', 'c', 2),
+				('IN_MOVED_TO', 'd', 1), ('IN_MOVED_FROM', 'e', 3), ('IN_MOVED_TO', 'f', 9)]:
+			watch.process_event(pyinotify_Event({'event_name': event_name, 'path': '/a', 'name': name, 'is_dir': False, 'cookie': cookie}))
+		watch._expire_moves(force=True)
+		self.assertTrue(seen == [('IN_MOVE', 'b', 'c'), ('IN_MOVE', 'a', 'd'), ('IN_CREATE', None, 'f'), ('IN_DELETE', None, 'e')])
+	
+	def testReplicaMoves(self):
+		""" Interleaved moves are renamed in the mirror, not copied again """
+		for workers in ('0', '2'):
+			os.system("rm -rf move_source move_mirror; mkdir move_source; echo x > move_source/x; echo y > move_source/y")
+			io = iObserver()
+			watch = iWatch(io, {'replica': replica}, {'move_source': {'plugins': 'replica', 'replica_destination': 'move_mirror',
+				'correlate_moves': 'yes', 'replica_workers': workers}})
+			plugin = watch._dispatch[0][1]
+			plugin._init_mirror(None)
+			os.system("mv move_source/x move_source/x2; mv move_source/y move_source/y2")
+			for (event_name, name, cookie) in [('IN_MOVED_FROM', 'x', 1), ('IN_MOVED_FROM', 'y', 2), ('IN_MOVED_TO', 'x2', 1), ('IN_MOVED_TO', 'y2', 2)]:
+				watch.process_event(pyinotify_Event({'event_name': event_name, 'path': 'move_source', 'name': name, 'is_dir': False, 'cookie': cookie}))
+			plugin._stop_pool()
+			self.assertTrue(sorted(os.listdir('move_mirror')) == ['x2', 'y2'])
+			self.assertTrue(plugin.get_stats()['copy_counts'] == {})
+			
+			# Created and renamed before the mirror had it: copied
+			os.system("echo z > move_source/z2")
+			for (event_name, name) in [('IN_MOVED_FROM', 'z'), ('IN_MOVED_TO', 'z2')]:
+				watch.process_event(pyinotify_Event({'event_name': event_name, 'path': 'move_source', 'name': name, 'is_dir': False, 'cookie': 3}))
+			watch.process_event(pyinotify_Event({'event_name': 'WATCH_DEAD', 'path': 'move_source'}))
+			self.assertTrue(open('move_mirror/z2').read() == 'z\n' and io.error() is None)
+		os.system("rm -rf move_source move_mirror")
+	
+	def testMetrics(self):
+		""" Events and plugin times are counted and served on a socket """
+		class Recorder(iPlugin):
+			def process_event(self, event):
+				pass
+		io = iObserver()
+		watch = iWatch(io, {'recorder': Recorder(None, None, {})}, {'/a': {'plugins': 'recorder'}})
+		for name in ('x', 'y'):
+			watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a', 'name': name, 'is_dir': False}))
+		metrics = watch.get_metrics()
+		self.assertTrue(metrics['events_by_type'] == {'IN_CREATE': 2})
+		self.assertTrue(metrics['plugins']['recorder']['events'] == 2)
+		self.assertTrue(len(metrics['slowest']) == 2 and metrics['pending']['moves'] == 0)
+		
+		io._watches = {'/a': watch}
+		server = iMetricsServer(io, 'metrics.sock')
+		try:
+			client = socket.socket(socket.AF_UNIX)
+			client.connect('metrics.sock')
+			client.sendall('json\n')
+			data = ''
+			while True:
+				chunk = client.recv(4096)
+				if not chunk:
+					break
+				data += chunk
+			client.close()
+			self.assertTrue(json.loads(data)['watches']['/a']['events'] == 2)
+		finally:
+			server.stop()
+		self.assertTrue('watches./a.events_by_type.IN_CREATE 2' in format_metrics(io.get_metrics()))
+		
+		# A reload moves the server to a changed path
+		io = iObserver({'global': {'metrics_socket': 'metrics.sock'}, 'watches': {}})
+		reloaded = {'global': dict(io._config['global']), 'watches': {}}
+		reloaded['global']['metrics_socket'] = 'moved.sock'
+		io._configure = lambda path: setattr(io, '_config', reloaded)
+		io._watches = {}
+		try:
+			io._obey_global_option('metrics_socket')
+			io._update_config()
+			self.assertTrue(io._metrics_server.path == 'moved.sock')
+		finally:
+			io._metrics_server.stop()
+	
+	def testTrace(self):
+		""" Received events are recorded relative to the watch """
+		if os.path.exists('events.trace'):
+			os.unlink('events.trace')
+		io = iObserver()
+		watch = iWatch(io, {'dummy': iPlugin(None, None, {})}, {'/a': {'plugins': 'dummy', 'trace': 'events.trace'}})
+		watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a/b', 'name': 'c', 'is_dir': True}))
+		watch.process_event(pyinotify_Event({'event_name': 'IN_MOVED_FROM', 'path': '/a', 'name': 'd', 'is_dir': False, 'cookie': 3}))
+		watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a', 'name': 'e', 'is_dir': False, 'synthetic': True}))
+		watch._die(iProcessEvent(watch))
+		entries = list(read_trace('events.trace'))
+		self.assertTrue(len(entries) == 2)
+		self.assertTrue(entries[0]['p'] == 'b' and entries[0]['n'] == 'c' and entries[0]['d'] == 1)
+		self.assertTrue(entries[1]['e'] == 'IN_MOVED_FROM' and entries[1]['p'] == '.' and entries[1]['c'] == 3)
+		os.unlink('events.trace')
+		
+		# A replay writes only into its scratch directory
+		os.system("rm -rf live_mirror replay_scratch; mkdir live_mirror; echo keep > live_mirror/keep")
+		open('events.trace', 'w').write('{"t":0,"e":"IN_CREATE","p":".","n":"new","s":3}\n')
+		io._plugins = {'replica': replica, 'scribe': scribe}
+		config = {'plugins': ['replica', 'scribe'], 'replica_destination': 'live_mirror',
+			'replica_manifest': 'live.manifest', 'scribe_log': 'live.log', 'trace': 'events.trace'}
+		self.assertTrue(replay.replay(io, config, 'events.trace', 'replay_scratch')[0] == 1)
+		self.assertTrue(os.listdir('live_mirror') == ['keep'] and open('live_mirror/keep').read() == 'keep\n')
+		self.assertFalse(os.path.exists('live.manifest') or os.path.exists('live.log'))
+		self.assertTrue(os.path.exists('replay_scratch/outputs/replica_destination/new'))
+		# Outputs that can't be told can't be redirected
+		io._plugins['other'] = iPlugin
+		self.assertRaises(ValueError, replay.redirect_outputs, io, {'plugins': 'other', 'other_file': 'x'}, 'replay_scratch')
+		os.system("rm -rf live_mirror replay_scratch events.trace")
+	
+	def testProfiling(self):
+		""" Plugins are profiled and slow events reported when asked to """
+		class Slow(iPlugin):
+			def process_event(self, event):
+				sleep(0.02)
+		io = iObserver()
+		watch = iWatch(io, {'slow': Slow(None, None, {})}, {'/a/b': {'plugins': 'slow', 'profile_plugins': 'yes', 'slow_event_ms': '10'}})
+		stderr = sys.stderr
+		sys.stderr = StringIO()
+		try:
+			watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a/b', 'name': 'c', 'is_dir': False}))
+			report = sys.stderr.getvalue()
+		finally:
+			sys.stderr = stderr
+		self.assertTrue(report.find("'slow'") != -1 and report.find('IN_CREATE') != -1)
+		written = watch.dump_profiles('.')
+		self.assertTrue(written == ['./a_b.slow.prof'])
+		self.assertTrue(pstats.Stats(written[0]).total_calls > 0)
+		os.unlink(written[0])
+		
+		# Without options of its own a watch follows the global ones
+		watch = iWatch(io, {'slow': Slow(None, None, {})}, {'/a/b': {'plugins': 'slow'}})
+		self.assertFalse(watch._profiling)
+		io._config['global']['profile_plugins'] = 'yes'
+		watch.configure_profiling()
+		self.assertTrue(watch._profiling)
+	
+	def testBatchDelivery(self):
+		""" Events read in one go reach process_events in one call """
+		class Batcher(iPlugin):
+			def process_events(self, events):
+				self.batches.append([event.name for event in events])
+		class Single(iPlugin):
+			def process_event(self, event):
+				self.names.append(event.name)
+		batcher = Batcher(None, None, {})
+		batcher.batches = []
+		single = Single(None, None, {})
+		single.names = []
+		io = iObserver()
+		watch = iWatch(io, {'batcher': batcher, 'single': single}, {'/a': {'plugins': ['batcher', 'single']}})
+		watch._begin_batch()
+		for name in ('x', 'y', 'z'):
+			watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a', 'name': name, 'is_dir': False}))
+		self.assertTrue(batcher.batches == [] and single.names == [])
+		watch._end_batch()
+		self.assertTrue(batcher.batches == [['x', 'y', 'z']] and single.names == ['x', 'y', 'z'])
+		self.assertTrue(watch.get_metrics()['plugins']['batcher']['events'] == 3)
+		
+		# Replica copies a file written many times once
+		os.system("rm -rf batch_source batch_mirror; mkdir batch_source; echo x > batch_source/x")
+		watch = iWatch(io, {'replica': replica}, {'batch_source': {'plugins': 'replica', 'replica_destination': 'batch_mirror'}})
+		watch._dispatch[0][1]._init_mirror(None)
+		os.system("echo y > batch_source/y")
+		watch._begin_batch()
+		for event_name in ('IN_CREATE', 'IN_MODIFY', 'IN_ATTRIB', 'IN_MODIFY'):
+			watch.process_event(pyinotify_Event({'event_name': event_name, 'path': 'batch_source', 'name': 'y', 'is_dir': False}))
+		watch._end_batch()
+		self.assertTrue(open('batch_mirror/y').read() == 'y\n')
+		self.assertTrue(sum(watch._dispatch[0][1].get_stats()['copy_counts'].values()) == 1)
+		os.system("rm -rf batch_source batch_mirror")
+	
+	def testPathFilter(self):
+		""" Excluded subtrees are neither walked nor passed on """
+		path_filter = iPathFilter('/w', ['*.py'], ['.git', '*.swp', 'build/out', 're:(^|/)cache[0-9]+$'])
+		self.assertTrue(not path_filter.wanted('/w/a/.git/objects/x', False) and not path_filter.wanted('/w/a.swp', False))
+		self.assertTrue(not path_filter.wanted('/w/build/out/a.py', False) and path_filter.wanted('/w/build/a.py', False))
+		self.assertTrue(not path_filter.wanted('/w/cache12', True) and not path_filter.wanted('/w/x.c', False))
+		self.assertTrue(path_filter.wanted('/w/src', True) and path_filter.wanted('/w', True))
+		
+		os.system("rm -rf filter_tree; mkdir -p filter_tree/src/.git/objects filter_tree/build/out/deep filter_tree/build/x")
+		root = os.path.abspath('filter_tree')
+		walker = iTreeWalker(root, 2, iPathFilter(root, exclude=['.git', 'build/out']))
+		found = sorted([directory[len(root) + 1:] for batch in walker.batches(10) for directory in batch])
+		self.assertTrue(found == ['build', 'build/x', 'src'])
+		os.system("rm -rf filter_tree")
+		
+		class Recorder(iPlugin):
+			def process_event(self, event):
+				self.names.append(event.name)
+		recorder = Recorder(None, None, {})
+		recorder.names = []
+		io = iObserver()
+		watch = iWatch(io, {'recorder': recorder}, {'/a': {'plugins': 'recorder', 'exclude': ['.git', '*~']}})
+		for (path, name) in [('/a', '.git'), ('/a/.git/refs', 'x'), ('/a', 'b~'), ('/a/b', 'c')]:
+			watch.process_event(pyinotify_Event({'event_name': 'IN_MODIFY', 'path': path, 'name': name, 'is_dir': False}))
+		self.assertTrue(recorder.names == ['c'])
+		# Events need not say whether they are about a directory
+		watch.process_event(pyinotify_Event({'event_name': 'IN_CREATE', 'path': '/a', 'name': 'd~'}))
+		self.assertTrue(recorder.names == ['c'])
+	
+	def testRecursivePoll(self):
+		""" A polled tree reports what changed in it as inotify events """
+		class Recorder(iPlugin):
+			def process_event(self, event):
+				self.events.append((event.event_name, getattr(event, 'name', None)))
+		recorder = Recorder(None, None, {})
+		recorder.events = []
+		os.system("rm -rf poll_tree; mkdir -p poll_tree/a; echo f > poll_tree/a/f")
+		io = iObserver()
+		watch = iRecursivePollWatch(io, {'recorder': recorder}, {'poll_tree': {'plugins': 'recorder', 'poll_min_interval_ms': '50'}})
+		self.assertTrue(watch._next_interval(0.05, False, 0.001) == 0.1 and watch._next_interval(0.1, True, 0.001) == 0.05)
+		self.assertTrue(watch._next_interval(20, False, 0.001) == 30 and watch._next_interval(0.05, True, 1) == 10)
+		watch.start()
+		try:
+			deadline = time() + 5
+			while not watch.get_progress()[1] and time() < deadline:
+				sleep(0.01)
+			self.assertTrue(watch.get_progress()[1])
+			os.system("mkdir poll_tree/b; echo g > poll_tree/b/g; echo more >> poll_tree/a/f")
+			expected = [('IN_CREATE', 'b'), ('IN_CREATE', 'g'), ('IN_MODIFY', 'f')]
+			deadline = time() + 5
+			while [event for event in expected if not event in recorder.events] and time() < deadline:
+				sleep(0.05)
+			self.assertTrue(recorder.events[1:] == expected)
+			os.system("rm -rf poll_tree/b")
+			deadline = time() + 5
+			while not ('IN_DELETE', 'b') in recorder.events and time() < deadline:
+				sleep(0.05)
+			self.assertTrue(recorder.events[-1] == ('IN_DELETE', 'b'))
+			# Only the permissions change
+			os.system("chmod 600 poll_tree/a/f")
+			deadline = time() + 5
+			while not ('IN_ATTRIB', 'f') in recorder.events and time() < deadline:
+				sleep(0.05)
+			self.assertTrue(recorder.events[-1] == ('IN_ATTRIB', 'f'))
+		finally:
+			watch.stop()
+			watch._thread.join(5)
+		self.assertTrue(recorder.events[-1] == ('WATCH_DEAD', None) and io.error() is None)
+		self.assertFalse(watch in io._cache._regions)
+		os.system("rm -rf poll_tree")
+	
 	def testLogging(self):
 		""" Test logging """
 		if os.path.exists('test'):
@@ -106,7 +788,7 @@ class iObserverTest(unittest.TestCase):
 		if os.path.exists('mirrored'):
 			os.system("rm -rf mirrored")
 		io = iObserver()
-		watch = iWatch(io, {'mirror': mirror}, {'./test': {'plugins': 'mirror', 'mirror_destination': 'mirrored'}})
+		watch = iWatch(io, {'replica': replica}, {'./test': {'plugins': 'replica', 'replica_destination': 'mirrored'}})
 		watch.start()
 		sleep(1)
 		os.system("touch test/foo")
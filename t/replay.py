@@ -0,0 +1,196 @@
+#!/usr/bin/python
+""" Play back a trace recorded by a watch (the trace option) through
+iWatch.process_event and the plugins of a watch, against a scratch tree.
+
+Usage: replay.py [options] trace config watch scratch
+
+The watch section of the config file (its plugins and their options)
+is used for a watch of scratch/tree. The options naming what the
+plugins write to (the mirror, the manifest, the log...) are pointed
+into scratch/outputs, so the replay never touches the recorded watch's
+outputs; a plugin that doesn't declare its outputs but has options is
+refused. Before each event is passed on, its effect is made in the
+scratch tree: objects are created
+(files with their recorded size), written to, deleted and moved, so
+the plugins find what they would have found. By default the events
+are played as fast as possible; with --recorded-speed they keep the
+recorded intervals.
+
+Reports the events played and the events per second, counting only the
+time spent in process_event. """
+
+from iobserver import *
+
+from optparse import OptionParser
+from types import ModuleType
+from time import time, sleep
+
+import shutil
+import json
+import os
+import os.path
+
+class Scratch(object):
+	""" Makes the effect of recorded events in the scratch tree """
+	def __init__(self, root):
+		self._root = root
+		# cookie -> path moved out
+		self._moved = {}
+
+	def path(self, entry):
+		return os.path.normpath(os.path.join(self._root, entry.get('p') or '.', entry.get('n') or ''))
+
+	def _resize(self, path, entry):
+		output = open(path, 'ab')
+		try:
+			output.truncate(entry.get('s', 0))
+		finally:
+			output.close()
+
+	def apply(self, entry):
+		path = self.path(entry)
+		event_name = entry['e']
+		try:
+			if event_name == 'IN_CREATE':
+				if entry.get('d'):
+					if not os.path.isdir(path):
+						os.makedirs(path)
+				else:
+					self._resize(path, entry)
+			elif event_name in ('IN_MODIFY', 'IN_CLOSE_WRITE') and not entry.get('d'):
+				self._resize(path, entry)
+			elif event_name == 'IN_ATTRIB':
+				os.utime(path, None)
+			elif event_name == 'IN_DELETE':
+				if os.path.isdir(path) and not os.path.islink(path):
+					shutil.rmtree(path)
+				elif os.path.lexists(path):
+					os.unlink(path)
+			elif event_name == 'IN_MOVED_FROM':
+				self._moved[entry.get('c')] = path
+			elif event_name == 'IN_MOVED_TO':
+				source = self._moved.pop(entry.get('c'), None)
+				if source and os.path.lexists(source):
+					os.rename(source, path)
+				elif entry.get('d'):
+					os.makedirs(path)
+				else:
+					self._resize(path, entry)
+		except (IOError, OSError):
+			# The trace may start in the middle of things
+			pass
+
+	def finish(self):
+		""" Moved out and never back: gone """
+		for path in self._moved.values():
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			elif os.path.lexists(path):
+				os.unlink(path)
+
+def redirect_outputs(observer, watch_config, directory):
+	""" Return watch_config with every output option of its plugins
+	pointing into directory, and without a trace. Raises ValueError if
+	a plugin with options doesn't declare its outputs. """
+	watch_config = dict(watch_config)
+	watch_config.pop('trace', None)
+	plugins = watch_config.get('plugins', [])
+	if not isinstance(plugins, list):
+		plugins = [plugins]
+	for plugin_name in plugins:
+		plugin = observer._plugins.get(plugin_name)
+		if isinstance(plugin, ModuleType):
+			plugin = getattr(plugin, plugin_name.title(), None)
+		outputs = getattr(plugin, 'outputs', None)
+		if outputs is None:
+			if [key for key in watch_config.keys() if key.startswith(plugin_name + '_')]:
+				raise ValueError("Plugin '%s' doesn't declare its outputs, they can't be redirected." % plugin_name)
+			continue
+		for option in outputs:
+			if watch_config.has_key(option):
+				watch_config[option] = os.path.join(directory, option)
+	return watch_config
+
+def replay(observer, watch_config, trace, scratch, recorded_speed=False):
+	""" Play the trace through a watch of scratch/tree, the plugins
+	writing into scratch/outputs; return (events, seconds spent in
+	process_event) """
+	outputs = os.path.join(scratch, 'outputs')
+	watch_config = redirect_outputs(observer, watch_config, outputs)
+	scratch = os.path.join(scratch, 'tree')
+	for directory in (scratch, outputs):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+	watch = iWatch(observer, observer._plugins, {scratch: watch_config})
+	tree = Scratch(scratch)
+	process_event = iProcessEvent(watch)
+
+	process_event.process_default(pyinotify_Event({'event_name': 'WATCH_INIT', 'path': scratch}))
+	events = 0
+	spent = 0.0
+	start = time()
+	for entry in read_trace(trace):
+		if recorded_speed:
+			delay = entry['t'] - (time() - start)
+			if delay > 0:
+				sleep(delay)
+		tree.apply(entry)
+		path = scratch
+		if entry.get('p') is not None:
+			path = os.path.normpath(os.path.join(scratch, entry['p']))
+		event = pyinotify_Event({
+			'event_name': entry['e'],
+			'path': path,
+			'name': entry.get('n', ''),
+			'is_dir': bool(entry.get('d')),
+			'cookie': entry.get('c', 0),
+		})
+		before = time()
+		watch.process_event(event)
+		spent += time() - before
+		events += 1
+	tree.finish()
+
+	before = time()
+	# What the watch's own loop would still do
+	watch._expire_moves(force=True)
+	watch._flush_events(force=True)
+	watch._die(process_event)
+	observer._cache.drop_regions(watch)
+	spent += time() - before
+	return (events, spent)
+
+if __name__ == "__main__":
+	parser = OptionParser(usage="%prog [options] trace config watch scratch")
+	parser.add_option('--recorded-speed', action='store_true', default=False,
+		help="keep the recorded intervals between events")
+	parser.add_option('--json', action='store_true', default=False, help="print the result as JSON")
+	(options, arguments) = parser.parse_args()
+	if len(arguments) != 4:
+		parser.error("trace, config, watch and scratch are needed")
+	(trace, config, watch, scratch) = arguments
+
+	observer = iObserver(config)
+	# The observer keys its watches by their real paths
+	watch = os.path.realpath(watch)
+	if not observer._config['watches'].has_key(watch):
+		parser.error("No watch '%s' in %s" % (watch, config))
+	scratch = os.path.abspath(scratch)
+	try:
+		redirect_outputs(observer, observer._config['watches'][watch], scratch)
+	except ValueError, data:
+		parser.error(str(data))
+
+	(events, spent) = replay(observer, observer._config['watches'][watch], trace, scratch, options.recorded_speed)
+	result = {
+		'events': events,
+		'seconds': spent,
+		'events_per_second': spent and events / spent or None,
+		'error': observer.error(),
+	}
+	if options.json:
+		print json.dumps(result)
+	else:
+		print "%d events in %.3f s: %.1f events/s" % (events, spent, result['events_per_second'] or 0)
+		if result['error']:
+			print "Error: %s" % result['error']